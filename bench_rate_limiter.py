@@ -0,0 +1,41 @@
+"""Microbenchmark: per-check cost and memory of the in-memory rate limiter
+
+Usage: python bench_rate_limiter.py [pairs]
+"""
+import sys
+import time
+import tracemalloc
+
+from sakura import MemoryRateLimiter, MESSAGE_LIMIT, RATE_LIMIT_COUNT, RATE_LIMIT_TTL, RATE_LIMIT_MAX_KEYS
+
+
+def fill(limiter: MemoryRateLimiter, pairs: int, current_time: float) -> float:
+    """Check `pairs` user/chat pairs once, returning ns per check"""
+    start = time.perf_counter()
+    for i in range(pairs):
+        limiter.check(i, -1000000000 - i % 1000, current_time)
+    return (time.perf_counter() - start) * 1e9 / pairs
+
+
+def main(pairs: int = 1_000_000):
+    now = time.time()
+    limiter = MemoryRateLimiter(MESSAGE_LIMIT, RATE_LIMIT_COUNT, RATE_LIMIT_TTL, max_keys=pairs)
+    insert_ns = fill(limiter, pairs, now)
+    hit_ns = fill(limiter, pairs, now + 0.5)
+    del limiter
+
+    # Memory is measured on a separate run, tracemalloc skews timings
+    tracemalloc.start()
+    limiter = MemoryRateLimiter(MESSAGE_LIMIT, RATE_LIMIT_COUNT, RATE_LIMIT_TTL, max_keys=pairs)
+    fill(limiter, pairs, now)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"pairs: {pairs:,} (capped at {RATE_LIMIT_MAX_KEYS:,} in production)")
+    print(f"check, new pair: {insert_ns:.0f} ns")
+    print(f"check, known pair: {hit_ns:.0f} ns")
+    print(f"memory: {current / 2**20:.1f} MiB ({current / pairs:.0f} B/pair)")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000)
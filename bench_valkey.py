@@ -0,0 +1,107 @@
+"""Benchmark and sanity check of the Valkey helpers against the in-process stand-in
+
+Runs the rate limit script, the per-update prefetch/flush pipelines and the value
+codec on FakeValkey, checking the results real Valkey would give along the way.
+
+Usage: FAKE_VALKEY_LATENCY_MS=0.5 python bench_valkey.py [updates]
+"""
+import os
+import sys
+import time
+import asyncio
+
+os.environ["STORAGE_BACKEND"] = "fake"
+
+import sakura
+
+
+async def check_rate_limit():
+    """Statuses of the rate limit script: 0 process, 1 ignore, 2 hard-limited"""
+    statuses = []
+    for _ in range(sakura.RATE_LIMIT_COUNT + 2):
+        result = await sakura.run_rate_limit_script(1, 1)
+        statuses.append(int(result[0]))
+
+    expected = [0] + [1] * (sakura.RATE_LIMIT_COUNT - 1) + [2, 2]
+    assert statuses == expected, f"rate limit statuses {statuses}, expected {expected}"
+
+    # Hard-limited pairs are answered from the shadow cache afterwards
+    assert await sakura.is_rate_limited(1, 1)
+    assert sakura.is_shadow_hard_limited(1, 1)
+
+
+async def check_update_pipeline():
+    """One round trip each for prefetch and flush, and the flushed writes are visible to the next prefetch"""
+    user_id, message, reply = 2, "hi sakura", "hii 🌸"
+    field = sakura.get_response_cache_key(user_id, message)
+    store = sakura.valkey_raw.store
+
+    round_trips = store.round_trips
+    state = await sakura.prefetch_update_state(user_id, 1, message)
+    assert store.round_trips - round_trips == 1, f"prefetch took {store.round_trips - round_trips} round trips"
+    assert not state.rate_limited and state.history == [] and state.cache[field] is None
+
+    token = sakura.current_update_state.set(state)
+    try:
+        await sakura.add_conversation_turn(user_id, message, reply)
+        await sakura.cache_response(user_id, field, reply)
+    finally:
+        sakura.current_update_state.reset(token)
+    round_trips = store.round_trips
+    await sakura.flush_update_state(state)
+    assert store.round_trips - round_trips == 1, f"flush took {store.round_trips - round_trips} round trips"
+
+    # Read back from the store, not L1 (a new chat avoids the per-chat rate limit)
+    sakura.l1_cache.clear()
+    state = await sakura.prefetch_update_state(user_id, 2, message)
+    assert not state.rate_limited
+    assert state.history == [{"role": "user", "content": message}, {"role": "assistant", "content": reply}]
+    assert state.cache[field] == reply
+
+
+async def check_codec():
+    """Small and compressed values survive the cache round trip"""
+    values = [42, "plain", {"nested": [1, 2, 3]}, ["large"] * sakura.COMPRESS_MIN_BYTES]
+    for i, value in enumerate(values):
+        assert await sakura.cache_set(f"bench:{i}", value)
+
+    sakura.l1_cache.clear()
+    for i, value in enumerate(values):
+        cached = await sakura.cache_get(f"bench:{i}")
+        assert cached == value, f"codec round trip of {value!r:.40} gave {cached!r:.40}"
+
+
+async def bench_updates(updates: int) -> tuple:
+    """Mean microseconds and round trips per update for prefetch + buffered writes + flush"""
+    round_trips = sakura.valkey_raw.store.round_trips
+    start = time.perf_counter()
+    for i in range(updates):
+        user_id = 1000 + i
+        state = await sakura.prefetch_update_state(user_id, 1, "hello")
+        token = sakura.current_update_state.set(state)
+        try:
+            await sakura.add_conversation_turn(user_id, "hello", "hii")
+        finally:
+            sakura.current_update_state.reset(token)
+        await sakura.flush_update_state(state)
+    elapsed = time.perf_counter() - start
+    return elapsed * 1e6 / updates, (sakura.valkey_raw.store.round_trips - round_trips) / updates
+
+
+async def main(updates: int = 10000):
+    assert await sakura.init_valkey(), "stand-in backend failed to initialize"
+
+    await check_rate_limit()
+    await check_update_pipeline()
+    await check_codec()
+    print(f"checks passed (codec: {sakura.VALUE_CODEC})")
+
+    per_update, round_trips = await bench_updates(updates)
+    print(f"updates: {updates:,} at {sakura.FAKE_VALKEY_LATENCY_MS}ms RTT")
+    print(f"prefetch + flush: {per_update:.0f} µs/update, {round_trips:.1f} round trips/update")
+
+    await sakura.close_valkey()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000))
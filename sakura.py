@@ -1,16 +1,29 @@
 import os
+import sys
 import time
 import json
+import math
 import uvloop
+import heapq
+import bisect
 import random
+import struct
+import hashlib
 import psutil
 import valkey
 import asyncio
 import aiohttp
+import msgpack
 import logging
 import asyncpg
 import datetime
 import threading
+import zstandard
+import contextvars
+from fnmatch import fnmatchcase
+from array import array
+from itertools import groupby
+from collections import OrderedDict
 from telegram import (
     Update,
     InlineKeyboardButton,
@@ -29,13 +42,15 @@ from telegram.ext import (
     PreCheckoutQueryHandler,
     ContextTypes,
     filters,
-    ChatMemberHandler
+    ChatMemberHandler,
+    BaseRateLimiter
 )
 from google import genai
 from typing import Dict, Set, Optional
-from telegram.error import TelegramError, Forbidden, BadRequest
+from telegram.error import TelegramError, Forbidden, BadRequest, RetryAfter
 from telethon import TelegramClient, events
 from valkey.asyncio import Valkey as AsyncValkey
+from valkey.asyncio.client import Pipeline as AsyncPipeline
 from telegram.constants import ParseMode, ChatAction
 from http.server import BaseHTTPRequestHandler, HTTPServer
 
@@ -54,25 +69,70 @@ SESSION_TTL = 3600
 CACHE_TTL = 300
 RATE_LIMIT_TTL = 60
 RATE_LIMIT_COUNT = 5
+RATE_LIMIT_MAX_KEYS = 200000
+UPSERT_FLUSH_MS = 2000
+UPSERT_BATCH_SIZE = 500
+UPSERT_REFRESH_INTERVAL = 3600
+UPSERT_FINGERPRINT_MAX = 500000
+ID_STARTUP_MODE = os.getenv("ID_STARTUP_MODE", "full")
+BLOOM_SNAPSHOT_PATH = os.getenv("BLOOM_SNAPSHOT_PATH", "known_ids.bloom")
+BLOOM_MIN_CAPACITY = 100000
+BLOOM_ERROR_RATE = 0.01
+BUYERS_PAGE_SIZE = 20
+BUYERS_CACHE_TTL = 3600
+BUYERS_CACHED_PAGES = 10
+BUYERS_NAME_LENGTH = 32
+ACTIVITY_FLUSH_INTERVAL = 60
+ACTIVITY_BUFFER_MAX = 100000
+METRICS_SAMPLE_INTERVAL = 5
+METRICS_SAMPLES = 60
+STATS_HISTORY_MINUTES = 1440
+STATS_PERSIST_MINUTES = 5
+STATS_SPARKLINE_WIDTH = 30
+STATS_RANGES = (1, 6, 24)
 MESSAGE_LIMIT = 1.0
-BROADCAST_DELAY = 0.03
+GLOBAL_SEND_RATE = 30
+GROUP_SEND_RATE = 1
+GROUP_SEND_BURST = 3
+BROADCAST_SEND_RATE = 25
+SEND_RETRIES = 2
 CHAT_LENGTH = 20
 CHAT_CLEANUP = 1800
 OLD_CHAT = 3600
+HTTP_POOL_SIZE = 100
+HTTP_TIMEOUT = 10
+VALUE_CODEC = os.getenv("VALUE_CODEC", "msgpack")
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "valkey")
+L1_CACHE_SIZE = 10000
+L1_INVALIDATION_CHANNEL = "sakura:l1_invalidate"
+FAKE_VALKEY_LATENCY_MS = float(os.getenv("FAKE_VALKEY_LATENCY_MS", "0"))
+VALKEY_BREAKER_FAILURES = 5
+VALKEY_SLOW_CALL = 0.5
+VALKEY_BREAKER_COOLDOWN = 15
+COMPRESS_MIN_BYTES = 512
 
 # GLOBAL STATE & MEMORY SYSTEM
-user_ids: Set[int] = set()
-group_ids: Set[int] = set()
 help_expanded: Dict[int, bool] = {}
 broadcast_mode: Dict[int, str] = {}
-user_message_counts: Dict[str, list] = {}
-rate_limited_users: Dict[str, float] = {}
 user_last_response_time: Dict[int, float] = {}
 conversation_history: Dict[int, list] = {}
+conversation_expiry: list = []
+help_expanded_dirty: Set[int] = set()
 db_pool = None
 cleanup_task = None
+migration_task = None
+invalidation_task = None
+activity_task = None
+active_users_pending: Set[int] = set()
 valkey_client: AsyncValkey = None
+valkey_raw: AsyncValkey = None
+http_session: aiohttp.ClientSession = None
 payment_storage = {}
+effects_unsupported: Set[str] = {"group", "supergroup", "channel"}
+effects_rejected: Set[str] = set()
+media_file_ids: Dict[str, str] = {}
+hard_limit_shadow: Dict[tuple, float] = {}
+rate_limit_script = None
 
 # Commands dictionary
 COMMANDS = [
@@ -375,11 +435,13 @@ It will be automatically broadcasted to all groups.
     "failed": "❌ Broadcast failed: {error}",
     "button_texts": {
         "users": "👥 Users ({count})",
-        "groups": "📢 Groups ({count})"
+        "groups": "📢 Groups ({count})",
+        "resume": "▶️ Resume broadcast"
     },
     "callback_answers": {
         "users": "👥 Broadcasting to users selected!",
-        "groups": "📢 Broadcasting to groups selected!"
+        "groups": "📢 Broadcasting to groups selected!",
+        "resume": "▶️ Resuming broadcast!"
     }
 }
 
@@ -614,43 +676,287 @@ try:
 except Exception as e:
     logger.error(f"❌ Failed to initialize Telethon effects client: {e}")
 
-# TELETHON EFFECTS FUNCTIONS
-async def send_with_effect(chat_id: int, text: str, reply_markup=None) -> bool:
-    """Send message with random effect using Telethon"""
-    if not effects_client:
-        logger.warning("⚠️ Telethon effects client not available")
-        return False
+# OUTBOUND RATE GOVERNOR
+class TokenBucket:
+    """Token bucket refilled continuously at `rate` tokens per second"""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def reserve(self) -> float:
+        """Take one token and return how long the caller must wait for it"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+    def is_idle(self) -> bool:
+        """Check if the bucket has refilled completely"""
+        return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.capacity
+
+
+class RateGovernor(BaseRateLimiter):
+    """Global and per-group send limiter shared by PTB and direct Bot API calls
+
+    Sends wait for a token from the global bucket, the broadcast bucket when sent
+    on the broadcast lane, and the per-chat bucket for message sends in groups.
+    A 429 pauses only the affected chat, or the broadcast lane for broadcast sends.
+    """
+
+    MAX_CHAT_BUCKETS = 10000
+
+    def __init__(self):
+        self.global_bucket = TokenBucket(GLOBAL_SEND_RATE, GLOBAL_SEND_RATE)
+        self.broadcast_bucket = TokenBucket(BROADCAST_SEND_RATE, BROADCAST_SEND_RATE)
+        self.chat_buckets: Dict[int, TokenBucket] = {}
+        self.paused_until: Dict[object, float] = {}
+
+    async def initialize(self) -> None:
+        logger.info("✅ Outbound rate governor ready")
+
+    async def shutdown(self) -> None:
+        self.chat_buckets.clear()
+        self.paused_until.clear()
+
+    @staticmethod
+    def _chat_key(chat_id) -> Optional[int]:
+        try:
+            return int(chat_id)
+        except (TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def _is_message_send(endpoint: str) -> bool:
+        return endpoint.startswith(("send", "copyMessage", "forwardMessage")) and endpoint != "sendChatAction"
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= self.MAX_CHAT_BUCKETS:
+                # Drop buckets of chats that went quiet
+                self.chat_buckets = {k: b for k, b in self.chat_buckets.items() if not b.is_idle()}
+            bucket = TokenBucket(GROUP_SEND_RATE, GROUP_SEND_BURST)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def acquire(self, chat_id, endpoint: str, lane: str = "interactive") -> None:
+        """Wait until a call to `endpoint` for `chat_id` may be sent"""
+        chat_key = self._chat_key(chat_id)
+        if chat_key is None and lane != "broadcast":
+            # Not a chat-bound call (getMe, answerCallbackQuery, ...)
+            return
+
+        now = time.monotonic()
+        wait = max(self.paused_until.get(chat_key, 0), self.paused_until.get(lane, 0)) - now
+
+        delay = self.global_bucket.reserve()
+        if lane == "broadcast":
+            delay = max(delay, self.broadcast_bucket.reserve())
+        if chat_key is not None and chat_key < 0 and self._is_message_send(endpoint):
+            delay = max(delay, self._chat_bucket(chat_key).reserve())
+
+        wait = max(wait, delay)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def pause(self, chat_id, lane: str, retry_after: float) -> None:
+        """Pause the affected chat (or the broadcast lane) after a flood wait"""
+        key = lane if lane == "broadcast" else self._chat_key(chat_id)
+        if key is None:
+            key = lane
+        self.paused_until[key] = max(self.paused_until.get(key, 0), time.monotonic() + retry_after)
+        logger.warning(f"⏳ Flood wait {retry_after}s for {key}")
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        """Throttle a PTB Bot API request and retry it after RetryAfter"""
+        chat_id = data.get("chat_id")
+        lane = "interactive"
+        if isinstance(rate_limit_args, dict):
+            lane = rate_limit_args.get("lane", lane)
+
+        for attempt in range(SEND_RETRIES + 1):
+            await self.acquire(chat_id, endpoint, lane)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                if isinstance(retry_after, datetime.timedelta):
+                    retry_after = retry_after.total_seconds()
+                self.pause(chat_id, lane, float(retry_after))
+                if attempt == SEND_RETRIES:
+                    raise
+
+
+rate_governor = RateGovernor()
+
+# BOT API HTTP CLIENT
+async def init_http_session():
+    """Initialize shared keep-alive HTTP session for direct Bot API calls"""
+    global http_session
 
     try:
-        url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
-        payload = {
-            'chat_id': chat_id,
-            'text': text,
-            'message_effect_id': random.choice(EFFECTS),
-            'parse_mode': 'HTML'
-        }
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_SIZE,
+            limit_per_host=HTTP_POOL_SIZE,
+            ttl_dns_cache=300,
+            keepalive_timeout=60
+        )
+        http_session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT)
+        )
+        logger.info("✅ Bot API HTTP session initialized")
+        return True
+    except Exception as e:
+        logger.error(f"❌ Failed to initialize Bot API HTTP session: {e}")
+        http_session = None
+        return False
+
+async def close_http_session():
+    """Close shared Bot API HTTP session"""
+    global http_session
 
-        # Add reply markup if provided
-        if reply_markup:
-            payload['reply_markup'] = reply_markup.to_json()
+    if http_session and not http_session.closed:
+        try:
+            await http_session.close()
+            logger.info("✅ Bot API HTTP session closed")
+        except Exception as e:
+            logger.error(f"❌ Error closing Bot API HTTP session: {e}")
+    http_session = None
 
-        async with aiohttp.ClientSession() as session:
+async def post_bot_api(method: str, payload: dict) -> dict:
+    """Post a Bot API request using the shared HTTP session"""
+    url = f"https://api.telegram.org/bot{BOT_TOKEN}/{method}"
+
+    if not http_session or http_session.closed:
+        # Session not available (startup/shutdown) - use a one-off session
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT)) as session:
             async with session.post(url, json=payload) as response:
-                result = await response.json()
-                if result.get('ok'):
-                    logger.info(f"✨ Effect message sent to {chat_id}")
-                    return True
+                return await response.json()
+
+    async with http_session.post(url, json=payload) as response:
+        return await response.json()
+
+async def call_bot_api(method: str, payload: dict, lane: str = "interactive") -> dict:
+    """Call a Bot API method directly through the rate governor"""
+    chat_id = payload.get('chat_id')
+
+    for attempt in range(SEND_RETRIES + 1):
+        await rate_governor.acquire(chat_id, method, lane)
+        result = await post_bot_api(method, payload)
+
+        if result.get('error_code') != 429 or attempt == SEND_RETRIES:
+            return result
+
+        retry_after = (result.get('parameters') or {}).get('retry_after', 1)
+        rate_governor.pause(chat_id, lane, float(retry_after))
+
+    return result
+
+# TELETHON EFFECTS FUNCTIONS
+async def send_effect_message(
+    chat_id: int,
+    chat_type: str,
+    text: str = None,
+    photo: str = None,
+    sticker: str = None,
+    reply_markup: InlineKeyboardMarkup = None,
+    reply_to: int = None,
+    parse_mode: Optional[str] = ParseMode.HTML,
+    disable_preview: bool = False,
+    use_effect: bool = True
+) -> dict:
+    """Send text, photo or sticker with a random effect, falling back to a plain send
+
+    Returns the sent message as a Bot API dict. Raises Forbidden, BadRequest or TelegramError if the plain send fails.
+    """
+    # Build payload once - the effect attempt and the plain send share it
+    media_url = None
+    if photo is not None:
+        method = "sendPhoto"
+        if photo.startswith(("http://", "https://")):
+            # Reuse Telegram's file_id for URLs we've uploaded before
+            media_url = photo
+            photo = await get_cached_file_id(media_url) or media_url
+        payload = {'chat_id': chat_id, 'photo': photo}
+        if text:
+            payload['caption'] = text
+    elif sticker is not None:
+        method = "sendSticker"
+        payload = {'chat_id': chat_id, 'sticker': sticker}
+    else:
+        method = "sendMessage"
+        payload = {'chat_id': chat_id, 'text': text}
+        if disable_preview:
+            payload['link_preview_options'] = {'is_disabled': True}
+
+    if text and parse_mode:
+        payload['parse_mode'] = parse_mode
+    if reply_markup:
+        payload['reply_markup'] = reply_markup.to_dict()
+    if reply_to and chat_type != "private":
+        # Quote like reply_text does: only outside private chats
+        payload['reply_parameters'] = {'message_id': reply_to, 'allow_sending_without_reply': True}
+
+    # Try with effect unless this chat type is known not to support effects
+    effect_ids = [effect_id for effect_id in EFFECTS if effect_id not in effects_rejected]
+    if use_effect and effects_client and effect_ids and chat_type not in effects_unsupported:
+        effect_id = random.choice(effect_ids)
+        try:
+            result = await call_bot_api(method, {**payload, 'message_effect_id': effect_id})
+            if result.get('ok'):
+                logger.info(f"✨ Effect {method} sent to {chat_id}")
+                await remember_sent_photo(media_url, payload, result['result'])
+                return result['result']
+
+            if media_url and payload['photo'] != media_url and is_stale_file_id(result):
+                # Cached file_id went stale - upload from URL again
+                await forget_file_id(media_url)
+                payload['photo'] = media_url
+            elif 'effect' in str(result.get('description', '')).lower():
+                if chat_type == "private":
+                    # Private chats support effects - this effect id is the problem
+                    effects_rejected.add(effect_id)
+                    logger.warning(f"⚠️ Effect {effect_id} rejected, dropping it from rotation")
                 else:
-                    logger.error(f"❌ Effect failed for {chat_id}: {result}")
-                    return False
-    except Exception as e:
-        logger.error(f"❌ Effect error for {chat_id}: {e}")
-        return False
+                    effects_unsupported.add(chat_type)
+                    logger.warning(f"⚠️ Effects not supported in {chat_type} chats, sending plain from now on")
+            else:
+                logger.error(f"❌ Effect {method} failed for {chat_id}: {result}")
+        except Exception as e:
+            logger.error(f"❌ Effect {method} error for {chat_id}: {e}")
+
+    # Plain send over the same transport
+    result = await call_bot_api(method, payload)
+    if not result.get('ok') and media_url and payload['photo'] != media_url and is_stale_file_id(result):
+        # Cached file_id went stale - upload from URL again
+        await forget_file_id(media_url)
+        payload['photo'] = media_url
+        result = await call_bot_api(method, payload)
+
+    if not result.get('ok'):
+        # Same exception types a PTB send would raise, so callers can tell blocked users apart
+        description = result.get('description', f"{method} failed")
+        if result.get('error_code') == 403:
+            raise Forbidden(description)
+        if result.get('error_code') == 400:
+            raise BadRequest(description)
+        raise TelegramError(description)
+
+    await remember_sent_photo(media_url, payload, result['result'])
+    return result['result']
 
 async def send_animated_reaction(chat_id: int, message_id: int, emoji: str) -> bool:
     """Send animated emoji reaction using direct API call"""
     try:
-        url = f"https://api.telegram.org/bot{BOT_TOKEN}/setMessageReaction"
         payload = {
             'chat_id': chat_id,
             'message_id': message_id,
@@ -658,15 +964,13 @@ async def send_animated_reaction(chat_id: int, message_id: int, emoji: str) -> b
             'is_big': True  # This makes the reaction animated/big
         }
 
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, json=payload) as response:
-                result = await response.json()
-                if result.get('ok'):
-                    logger.info(f"🎭 Animated reaction {emoji} sent to {chat_id}")
-                    return True
-                else:
-                    logger.error(f"❌ Animated reaction failed for {chat_id}: {result}")
-                    return False
+        result = await call_bot_api("setMessageReaction", payload)
+        if result.get('ok'):
+            logger.info(f"🎭 Animated reaction {emoji} sent to {chat_id}")
+            return True
+        else:
+            logger.error(f"❌ Animated reaction failed for {chat_id}: {result}")
+            return False
     except Exception as e:
         logger.error(f"❌ Animated reaction error for {chat_id}: {e}")
         return False
@@ -706,70 +1010,6 @@ async def add_ptb_reaction(context, update, emoji: str, user_info: Dict[str, any
     except Exception as e:
         log_with_user_info("WARNING", f"⚠️ PTB reaction fallback failed: {e}", user_info)
 
-async def send_with_effect_photo(chat_id: int, photo_url: str, caption: str, reply_markup=None) -> bool:
-    """Send photo message with random effect using direct API"""
-    if not effects_client:
-        logger.warning("⚠️ Telethon effects client not available")
-        return False
-
-    try:
-        url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendPhoto"
-        payload = {
-            'chat_id': chat_id,
-            'photo': photo_url,
-            'caption': caption,
-            'message_effect_id': random.choice(EFFECTS),
-            'parse_mode': 'HTML'
-        }
-
-        # Add reply markup if provided
-        if reply_markup:
-            payload['reply_markup'] = reply_markup.to_json()
-
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, json=payload) as response:
-                result = await response.json()
-                if result.get('ok'):
-                    logger.info(f"✨ Effect photo sent to {chat_id}")
-                    return True
-                else:
-                    logger.error(f"❌ Photo effect failed for {chat_id}: {result}")
-                    return False
-    except Exception as e:
-        logger.error(f"❌ Photo effect error for {chat_id}: {e}")
-        return False
-    """Send photo message with random effect using direct API"""
-    if not effects_client:
-        logger.warning("⚠️ Telethon effects client not available")
-        return False
-
-    try:
-        url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendPhoto"
-        payload = {
-            'chat_id': chat_id,
-            'photo': photo_url,
-            'caption': caption,
-            'message_effect_id': random.choice(EFFECTS),
-            'parse_mode': 'HTML'
-        }
-
-        # Add reply markup if provided
-        if reply_markup:
-            payload['reply_markup'] = reply_markup.to_json()
-
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, json=payload) as response:
-                result = await response.json()
-                if result.get('ok'):
-                    logger.info(f"✨ Effect photo sent to {chat_id}")
-                    return True
-                else:
-                    logger.error(f"❌ Photo effect failed for {chat_id}: {result}")
-                    return False
-    except Exception as e:
-        logger.error(f"❌ Photo effect error for {chat_id}: {e}")
-        return False
-
 async def start_effects_client():
     """Start Telethon effects client"""
     global effects_client
@@ -802,11 +1042,23 @@ except Exception as e:
 
 # VALKEY FUNCTIONS
 async def init_valkey():
-    """Initialize Valkey connection"""
-    global valkey_client
+    """Initialize the storage backend (Valkey, in-process stand-in or memory only)"""
+    global valkey_client, valkey_raw
+
+    if STORAGE_BACKEND == "memory":
+        logger.info("📦 Storage backend: memory only, Valkey disabled")
+        return False
+
+    if STORAGE_BACKEND == "fake":
+        store = FakeValkeyStore(latency=FAKE_VALKEY_LATENCY_MS / 1000)
+        valkey_client = FakeValkey(store, decode_responses=True)
+        valkey_raw = FakeValkey(store, decode_responses=False)
+        logger.info(f"📦 Storage backend: in-process Valkey stand-in ({FAKE_VALKEY_LATENCY_MS}ms RTT)")
+        await load_rate_limit_script()
+        return True
 
     try:
-        valkey_client = AsyncValkey.from_url(
+        valkey_client = GuardedValkey.from_url(
             VALKEY_URL,
             decode_responses=True,
             socket_connect_timeout=5,
@@ -815,40 +1067,737 @@ async def init_valkey():
             health_check_interval=30
         )
 
+        # Binary-safe client for codec-encoded per-user values
+        valkey_raw = GuardedValkey.from_url(
+            VALKEY_URL,
+            decode_responses=False,
+            socket_connect_timeout=5,
+            socket_timeout=5,
+            retry_on_timeout=True,
+            health_check_interval=30
+        )
+
         # Test connection
         await valkey_client.ping()
+        await valkey_raw.ping()
         logger.info("✅ Valkey client initialized and connected successfully")
+
+        await load_rate_limit_script()
         return True
 
     except Exception as e:
         logger.error(f"❌ Failed to initialize Valkey client: {e}")
         valkey_client = None
+        valkey_raw = None
         return False
 
 async def close_valkey():
     """Close Valkey connection"""
-    global valkey_client
+    global valkey_client, valkey_raw
 
     if valkey_client:
         try:
             await valkey_client.aclose()
+            if valkey_raw:
+                await valkey_raw.aclose()
             logger.info("✅ Valkey connection closed")
         except Exception as e:
             logger.error(f"❌ Error closing Valkey connection: {e}")
 
+# VALKEY CIRCUIT BREAKER
+class ValkeyCircuitOpen(valkey.exceptions.ConnectionError):
+    """Raised instead of calling Valkey while the circuit is open"""
+
+class CircuitBreaker:
+    """Opens after repeated failures or slow calls, probes when half-open, closes when Valkey answers"""
+
+    def __init__(self, failure_threshold: int, slow_call: float, cooldown: float):
+        self.failure_threshold = failure_threshold
+        self.slow_call = slow_call
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.trips = 0
+        self.opened_at = 0.0
+        self.last_error = None
+        self.probe_task = None
+
+    def allow(self) -> bool:
+        """Check if calls may go to Valkey, starting a probe once the cooldown has passed"""
+        if self.state == "closed":
+            return True
+
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.cooldown:
+            self.state = "half_open"
+            self.probe_task = asyncio.create_task(probe_valkey())
+
+        return False
+
+    def record_success(self, latency: float):
+        """Record a completed call, counting slow ones as failures"""
+        if latency >= self.slow_call:
+            self.record_failure(f"slow call ({latency * 1000:.0f}ms)")
+        else:
+            self.failures = 0
+
+    def record_failure(self, error):
+        """Record a failed call and trip once the threshold is reached"""
+        self.failures += 1
+        self.last_error = str(error) or type(error).__name__
+        if self.state == "closed" and self.failures >= self.failure_threshold:
+            self.trips += 1
+            self.open()
+            logger.warning(f"⚡ Valkey circuit opened after {self.failures} failures: {self.last_error}")
+
+    def open(self):
+        """Route calls to the memory fallback until the next probe"""
+        self.state = "open"
+        self.opened_at = time.monotonic()
+
+    def close(self):
+        """Send calls to Valkey again"""
+        self.state = "closed"
+        self.failures = 0
+        logger.info("✅ Valkey circuit closed")
+
+valkey_breaker = CircuitBreaker(VALKEY_BREAKER_FAILURES, VALKEY_SLOW_CALL, VALKEY_BREAKER_COOLDOWN)
+
+def valkey_ready() -> bool:
+    """Check if Valkey is connected and its circuit is closed"""
+    return valkey_client is not None and valkey_breaker.allow()
+
+async def run_guarded(call, *args, **kwargs):
+    """Run a Valkey call through the circuit breaker, failing fast while it is open"""
+    if valkey_breaker.state != "closed":
+        raise ValkeyCircuitOpen("Valkey circuit is open")
+
+    start = time.monotonic()
+    try:
+        result = await call(*args, **kwargs)
+    except (valkey.exceptions.ConnectionError, valkey.exceptions.TimeoutError, OSError, asyncio.TimeoutError) as e:
+        valkey_breaker.record_failure(e)
+        raise
+
+    elapsed = time.monotonic() - start
+    valkey_breaker.record_success(elapsed)
+    stats_history.observe("valkey_rtt", elapsed)
+    return result
+
+class GuardedPipeline(AsyncPipeline):
+    """Pipeline whose execute goes through the circuit breaker"""
+
+    async def execute(self, raise_on_error: bool = True):
+        return await run_guarded(super().execute, raise_on_error)
+
+class GuardedValkey(AsyncValkey):
+    """Valkey client whose commands and pipelines go through the circuit breaker"""
+
+    async def execute_command(self, *args, **options):
+        return await run_guarded(super().execute_command, *args, **options)
+
+    def pipeline(self, transaction: bool = True, shard_hint=None):
+        return GuardedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+async def probe_valkey():
+    """Half-open probe: ping Valkey past the breaker and close the circuit if it answers in time"""
+    try:
+        await asyncio.wait_for(AsyncValkey.execute_command(valkey_client, "PING"), timeout=VALKEY_SLOW_CALL)
+    except Exception as e:
+        valkey_breaker.last_error = str(e) or type(e).__name__
+        valkey_breaker.open()
+        logger.debug(f"⚡ Valkey probe failed, circuit stays open: {valkey_breaker.last_error}")
+        return
+
+    valkey_breaker.close()
+
+    # L1 may predate the outage and rehydration rewrites history
+    l1_cache.clear()
+    await rehydrate_valkey()
+
+async def rehydrate_valkey():
+    """Push state kept in memory while the circuit was open back to Valkey"""
+    histories = [(user_id, messages) for user_id, messages in conversation_history.items() if messages]
+    dirty_help = list(help_expanded_dirty)
+
+    if not histories and not dirty_help:
+        return
+
+    try:
+        pipe = valkey_raw.pipeline(transaction=False)
+        for user_id, messages in histories:
+            key = user_history_key(user_id)
+            pipe.rpush(key, *[encode_history_message(message) for message in messages])
+            pipe.ltrim(key, -CHAT_LENGTH, -1)
+            touch_user_keys(pipe, user_id)
+        for user_id in dirty_help:
+            pipe.hset(user_key(user_id), "state:help_expanded", encode_value(help_expanded.get(user_id, False)))
+            touch_user_keys(pipe, user_id)
+        await pipe.execute()
+
+        # Valkey is the source of truth again for these users
+        for user_id, messages in histories:
+            if conversation_history.get(user_id) is messages:
+                del conversation_history[user_id]
+        help_expanded_dirty.difference_update(dirty_help)
+
+        logger.info(f"✅ Rehydrated Valkey with {len(histories)} conversations and {len(dirty_help)} help states")
+
+    except Exception as e:
+        logger.error(f"❌ Failed to rehydrate Valkey: {e}")
+
+# IN-PROCESS VALKEY STAND-IN
+# Storage backends (STORAGE_BACKEND):
+#   valkey  GuardedValkey clients against VALKEY_URL
+#   fake    FakeValkey below - same commands, pipelines, TTLs and rate limit script,
+#           in process, with FAKE_VALKEY_LATENCY_MS added per round trip
+#   memory  no Valkey client, helpers use the in-memory dicts
+# The fake implements exactly the command subset the helpers use.
+def fake_rate_limit_script(store, keys: list, args: list) -> list:
+    """Python port of RATE_LIMIT_LUA for the in-process stand-in"""
+    hard_key, count_key = keys
+    window_ms, max_count, hard_ttl = int(args[0]), int(args[1]), int(args[2])
+
+    ttl = store.cmd_pttl(hard_key)
+    if ttl > 0:
+        return [2, ttl]
+
+    count = store.cmd_incr(count_key)
+    if count == 1:
+        store.cmd_pexpire(count_key, window_ms)
+    if count > max_count:
+        store.cmd_set(hard_key, "1", ex=hard_ttl)
+        return [2, hard_ttl * 1000]
+    if count > 1:
+        return [1, 0]
+    return [0, 0]
+
+def to_bytes(value) -> bytes:
+    """Encode a command argument the way Valkey stores it"""
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, str):
+        return value.encode()
+    return str(value).encode()
+
+def decode_reply(value):
+    """Decode a reply for clients created with decode_responses=True"""
+    if isinstance(value, bytes):
+        return value.decode()
+    if isinstance(value, list):
+        return [decode_reply(item) for item in value]
+    if isinstance(value, dict):
+        return {decode_reply(k): decode_reply(v) for k, v in value.items()}
+    return value
+
+class FakeValkeyStore:
+    """Keyspace shared by the stand-in clients: values, lazy TTLs and loaded scripts"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.data: Dict[bytes, any] = {}
+        self.expires: Dict[bytes, float] = {}
+        self.scripts: Dict[str, str] = {}
+        self.round_trips = 0
+
+    async def round_trip(self):
+        """Simulate one network round trip"""
+        self.round_trips += 1
+        await asyncio.sleep(self.latency)
+
+    def lookup(self, key) -> any:
+        """Get a live value, dropping it if its TTL has passed"""
+        key = to_bytes(key)
+        expires_at = self.expires.get(key)
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self.expires[key]
+            self.data.pop(key, None)
+        return self.data.get(key)
+
+    def store(self, key, value, keep_ttl: bool = False):
+        """Set a value, clearing any TTL unless asked to keep it"""
+        key = to_bytes(key)
+        self.data[key] = value
+        if not keep_ttl:
+            self.expires.pop(key, None)
+
+    def cmd_ping(self):
+        return True
+
+    def cmd_get(self, key):
+        return self.lookup(key)
+
+    def cmd_set(self, key, value, ex: int = None):
+        self.store(key, to_bytes(value))
+        if ex:
+            self.cmd_expire(key, ex)
+        return True
+
+    def cmd_setex(self, key, ttl: int, value):
+        return self.cmd_set(key, value, ex=ttl)
+
+    def cmd_incr(self, key) -> int:
+        value = int(self.lookup(key) or 0) + 1
+        self.store(key, to_bytes(value), keep_ttl=True)
+        return value
+
+    def cmd_delete(self, *keys) -> int:
+        deleted = 0
+        for key in keys:
+            if self.lookup(key) is not None:
+                del self.data[to_bytes(key)]
+                self.expires.pop(to_bytes(key), None)
+                deleted += 1
+        return deleted
+
+    def cmd_exists(self, *keys) -> int:
+        return sum(1 for key in keys if self.lookup(key) is not None)
+
+    def cmd_pexpire(self, key, ms: int) -> bool:
+        if self.lookup(key) is None:
+            return False
+        self.expires[to_bytes(key)] = time.monotonic() + int(ms) / 1000
+        return True
+
+    def cmd_expire(self, key, seconds: int) -> bool:
+        return self.cmd_pexpire(key, int(seconds) * 1000)
+
+    def cmd_ttl(self, key) -> int:
+        ttl = self.cmd_pttl(key)
+        return ttl if ttl < 0 else (ttl + 999) // 1000
+
+    def cmd_pttl(self, key) -> int:
+        if self.lookup(key) is None:
+            return -2
+        expires_at = self.expires.get(to_bytes(key))
+        if expires_at is None:
+            return -1
+        return int((expires_at - time.monotonic()) * 1000)
+
+    def cmd_hget(self, key, field):
+        return (self.lookup(key) or {}).get(to_bytes(field))
+
+    def cmd_hgetall(self, key) -> dict:
+        return dict(self.lookup(key) or {})
+
+    def cmd_hset(self, key, field=None, value=None, mapping: dict = None) -> int:
+        items = dict(mapping or {})
+        if field is not None:
+            items[field] = value
+        hash_value = self.lookup(key)
+        if hash_value is None:
+            hash_value = {}
+            self.store(key, hash_value)
+        added = 0
+        for item_field, item_value in items.items():
+            added += to_bytes(item_field) not in hash_value
+            hash_value[to_bytes(item_field)] = to_bytes(item_value)
+        return added
+
+    def cmd_hsetnx(self, key, field, value) -> bool:
+        if self.cmd_hget(key, field) is not None:
+            return False
+        return bool(self.cmd_hset(key, field, value))
+
+    def cmd_hdel(self, key, *fields) -> int:
+        hash_value = self.lookup(key) or {}
+        deleted = sum(1 for field in fields if hash_value.pop(to_bytes(field), None) is not None)
+        if hash_value == {} and self.lookup(key) is not None:
+            self.cmd_delete(key)
+        return deleted
+
+    def cmd_rpush(self, key, *values) -> int:
+        list_value = self.lookup(key)
+        if list_value is None:
+            list_value = []
+            self.store(key, list_value)
+        list_value.extend(to_bytes(value) for value in values)
+        return len(list_value)
+
+    def cmd_lrange(self, key, start: int, stop: int) -> list:
+        list_value = self.lookup(key) or []
+        start, stop = int(start), int(stop)
+        if start < 0:
+            start = max(len(list_value) + start, 0)
+        if stop < 0:
+            stop += len(list_value)
+        return list_value[start:stop + 1]
+
+    def cmd_ltrim(self, key, start: int, stop: int) -> bool:
+        list_value = self.lookup(key)
+        if list_value is not None:
+            list_value[:] = self.cmd_lrange(key, start, stop)
+            if not list_value:
+                self.cmd_delete(key)
+        return True
+
+    def cmd_pfadd(self, key, *elements) -> int:
+        # Exact set in place of a HyperLogLog sketch
+        members = self.lookup(key)
+        if members is None:
+            members = set()
+            self.store(key, members)
+        before = len(members)
+        members.update(to_bytes(element) for element in elements)
+        return int(len(members) > before)
+
+    def cmd_pfcount(self, *keys) -> int:
+        members = set()
+        for key in keys:
+            members.update(self.lookup(key) or ())
+        return len(members)
+
+    def cmd_publish(self, channel, message) -> int:
+        # Single process: there are no other replicas to notify
+        return 0
+
+    def cmd_script_load(self, script: str) -> str:
+        sha = hashlib.sha1(script.encode()).hexdigest()
+        self.scripts[sha] = script
+        return sha
+
+    def cmd_evalsha(self, sha: str, numkeys: int, *keys_and_args) -> list:
+        script = self.scripts.get(sha)
+        if script != RATE_LIMIT_LUA:
+            raise valkey.exceptions.NoScriptError("No matching script. Please use EVAL.")
+        return fake_rate_limit_script(self, list(keys_and_args[:numkeys]), list(keys_and_args[numkeys:]))
+
+class FakeScript:
+    """Stand-in for a registered script object"""
+
+    def __init__(self, client, script: str):
+        self.client = client
+        self.sha = hashlib.sha1(script.encode()).hexdigest()
+
+    async def __call__(self, keys: list = None, args: list = None, client=None):
+        client = client or self.client
+        keys, args = keys or [], args or []
+        result = client.evalsha(self.sha, len(keys), *keys, *args)
+        if isinstance(client, FakePipeline):
+            # Like valkey-py: a pipeline holding scripts checks them with SCRIPT EXISTS on execute
+            client.scripts.add(self.sha)
+            return client
+        return await result
+
+class FakePipeline:
+    """Queues stand-in commands and runs them in one round trip"""
+
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+        self.scripts: Set[str] = set()
+
+    def __getattr__(self, name: str):
+        command = getattr(self.client.store, f"cmd_{name}", None)
+        if command is None:
+            raise AttributeError(name)
+
+        def queue(*args, **kwargs):
+            self.commands.append((command, args, kwargs))
+            return self
+
+        return queue
+
+    async def execute(self, raise_on_error: bool = True) -> list:
+        if self.scripts:
+            # SCRIPT EXISTS for registered scripts goes out as its own round trip
+            await self.client.store.round_trip()
+            self.scripts = set()
+        await self.client.store.round_trip()
+
+        results = []
+        for command, args, kwargs in self.commands:
+            try:
+                results.append(self.client.reply(command(*args, **kwargs)))
+            except Exception as e:
+                if raise_on_error:
+                    raise
+                results.append(e)
+
+        self.commands = []
+        return results
+
+class FakeValkey:
+    """In-process async stand-in for the valkey.asyncio client"""
+
+    def __init__(self, store: FakeValkeyStore, decode_responses: bool = False):
+        self.store = store
+        self.decode_responses = decode_responses
+
+    def reply(self, value):
+        return decode_reply(value) if self.decode_responses else value
+
+    def __getattr__(self, name: str):
+        command = getattr(self.store, f"cmd_{name}", None)
+        if command is None:
+            raise AttributeError(name)
+
+        async def call(*args, **kwargs):
+            await self.store.round_trip()
+            return self.reply(command(*args, **kwargs))
+
+        return call
+
+    def pipeline(self, transaction: bool = True) -> FakePipeline:
+        return FakePipeline(self)
+
+    def register_script(self, script: str) -> FakeScript:
+        return FakeScript(self, script)
+
+    async def scan_iter(self, match: str = None, count: int = None):
+        await self.store.round_trip()
+        for key in list(self.store.data):
+            if self.store.lookup(key) is not None and (match is None or fnmatchcase(key.decode(), match)):
+                yield self.reply(key)
+
+    async def aclose(self):
+        pass
+
+# VALUE CODEC
+# Encoded values are <version byte><payload>. Values without a known version byte
+# were written as plain JSON before the codec existed and are still readable.
+CODEC_JSON = 0x01
+CODEC_MSGPACK = 0x02
+CODEC_ZSTD = 0x80
+CODEC_VERSIONS = {CODEC_JSON, CODEC_MSGPACK, CODEC_JSON | CODEC_ZSTD, CODEC_MSGPACK | CODEC_ZSTD}
+zstd_compressor = zstandard.ZstdCompressor(level=3)
+zstd_decompressor = zstandard.ZstdDecompressor()
+
+def encode_value(value: any, compress: bool = False) -> bytes:
+    """Encode a value with the configured codec behind a version byte"""
+    if VALUE_CODEC == "json":
+        version = CODEC_JSON
+        payload = json.dumps(value, separators=(",", ":"), ensure_ascii=False).encode()
+    else:
+        version = CODEC_MSGPACK
+        payload = msgpack.packb(value, use_bin_type=True)
+
+    # Compress only large payloads, small ones grow under zstd
+    if compress and len(payload) >= COMPRESS_MIN_BYTES:
+        version |= CODEC_ZSTD
+        payload = zstd_compressor.compress(payload)
+
+    return bytes((version,)) + payload
+
+def decode_value(data) -> any:
+    """Decode a codec value, falling back to legacy JSON"""
+    if not data:
+        return None
+    if isinstance(data, str):
+        data = data.encode()
+
+    version = data[0]
+    if version not in CODEC_VERSIONS:
+        return json.loads(data)
+
+    payload = data[1:]
+    if version & CODEC_ZSTD:
+        payload = zstd_decompressor.decompress(payload)
+
+    if version & ~CODEC_ZSTD == CODEC_MSGPACK:
+        return msgpack.unpackb(payload, raw=False)
+    return json.loads(payload)
+
+def encode_history_message(message: dict) -> bytes:
+    """Encode a history message as a compact [role, content] pair"""
+    return encode_value([message["role"], message["content"]], compress=True)
+
+def decode_history_message(data) -> dict:
+    """Decode a history message (compact pair or legacy JSON object)"""
+    message = decode_value(data)
+    if isinstance(message, list):
+        role, content = message
+        return {"role": role, "content": content}
+    return message
+
+# USER HASH SCHEMA
+# Per-user keys share the {user_id} hash tag so they land in one cluster slot:
+#   user:{id}               hash - session, state:<name>, last_response
+#   user:{id}:history       list - conversation history
+#   user:{id}:resp:<md5>    cached Gemini response with its own TTL
+#   user:{id}:count:<chat>  rate limit counter, user:{id}:hard:<chat> hard limit flag
+LEGACY_USER_KEY_PATTERNS = ["session:*", "user_state:*", "last_response:*", "conversation:*"]
+
+def user_key(user_id: int) -> str:
+    """Get the per-user hash key"""
+    return f"user:{{{user_id}}}"
+
+def user_history_key(user_id: int) -> str:
+    """Get the per-user conversation list key"""
+    return f"user:{{{user_id}}}:history"
+
+def user_response_key(user_id: int, field: str) -> str:
+    """Get the per-user cached response key for a resp:<md5> field"""
+    return f"user:{{{user_id}}}:{field}"
+
+def touch_user_keys(pipe, user_id: int):
+    """Slide the shared TTL of the user's hash and history on a pipeline"""
+    pipe.expire(user_key(user_id), SESSION_TTL)
+    pipe.expire(user_history_key(user_id), SESSION_TTL)
+
+async def set_user_fields(user_id: int, fields: dict):
+    """Set fields on the user's hash and slide its TTL in one round trip"""
+    pipe = valkey_raw.pipeline(transaction=False)
+    pipe.hset(user_key(user_id), mapping=fields)
+    touch_user_keys(pipe, user_id)
+    await pipe.execute()
+
+async def migrate_legacy_user_key(key: str) -> bool:
+    """Move one old flat per-user key into the per-user hash schema"""
+    prefix, _, raw_id = key.partition(":")
+    if not raw_id.lstrip("-").isdigit():
+        return False
+
+    user_id = int(raw_id)
+    hash_key = user_key(user_id)
+    pipe = valkey_raw.pipeline(transaction=True)
+
+    # HSETNX / empty-list checks keep anything already written in the new schema
+    if prefix == "last_response":
+        value = await valkey_client.get(key)
+        if value:
+            pipe.hsetnx(hash_key, prefix, value)
+    elif prefix == "session":
+        value = await valkey_client.get(key)
+        if value:
+            pipe.hsetnx(hash_key, prefix, encode_value(json.loads(value)))
+    elif prefix == "user_state":
+        value = await valkey_client.get(key)
+        for name, item in (json.loads(value) if value else {}).items():
+            pipe.hsetnx(hash_key, f"state:{name}", encode_value(item))
+    elif prefix == "conversation":
+        value = await valkey_client.get(key)
+        messages = json.loads(value) if value else []
+        items = [encode_history_message(message) for message in messages]
+        if items and not await valkey_client.exists(user_history_key(user_id)):
+            pipe.rpush(user_history_key(user_id), *items[-CHAT_LENGTH:])
+
+    touch_user_keys(pipe, user_id)
+    pipe.delete(key)
+    queue_invalidation(pipe, f"help:{user_id}", f"state:{user_id}", f"history:{user_id}")
+    await pipe.execute()
+    l1_cache.delete(f"help:{user_id}", f"state:{user_id}", f"history:{user_id}")
+    return True
+
+async def migrate_legacy_user_keys(batch_size: int = 500):
+    """Online migration of old flat per-user keys into the per-user hash schema"""
+    if not valkey_ready():
+        return
+
+    logger.info("🔀 Legacy user key migration started")
+    migrated = 0
+
+    try:
+        for pattern in LEGACY_USER_KEY_PATTERNS:
+            async for key in valkey_client.scan_iter(match=pattern, count=batch_size):
+                try:
+                    if await migrate_legacy_user_key(key):
+                        migrated += 1
+                except Exception as e:
+                    logger.error(f"❌ Failed to migrate legacy key {key}: {e}")
+
+        logger.info(f"✅ Legacy user key migration completed: {migrated} keys migrated")
+
+    except asyncio.CancelledError:
+        logger.info(f"🔀 Legacy user key migration cancelled after {migrated} keys")
+        raise
+    except Exception as e:
+        logger.error(f"❌ Legacy user key migration failed: {e}")
+
+# L1 CACHE
+# Bounded in-process LRU in front of Valkey. Writes go through to Valkey and update
+# L1; other replicas drop the written keys when they see the invalidation message.
+# L1 keys: help:<user>, state:<user>, history:<user>, resp:<user>:<field>, cache:<key>
+NODE_ID = f"{os.getpid()}-{random.getrandbits(32):08x}"
+
+class LRUCache:
+    """Bounded LRU with a TTL per entry"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.entries: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> any:
+        """Get a live entry or None"""
+        entry = self.entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: str, value: any, ttl: int):
+        """Set an entry, evicting the least recently used ones over the size limit"""
+        self.entries[key] = (time.monotonic() + ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def delete(self, *keys: str):
+        """Drop entries"""
+        for key in keys:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        """Drop all entries"""
+        self.entries.clear()
+
+l1_cache = LRUCache(L1_CACHE_SIZE)
+
+def invalidation_message(keys: list) -> str:
+    """Build the pub/sub message telling other replicas which L1 keys changed"""
+    return json.dumps([NODE_ID, keys])
+
+def queue_invalidation(pipe, *keys: str):
+    """Queue an L1 invalidation on a pipeline next to the write it covers"""
+    pipe.publish(L1_INVALIDATION_CHANNEL, invalidation_message(list(keys)))
+
+async def l1_invalidation_listener():
+    """Drop L1 entries written by other replicas (Valkey pub/sub)"""
+    logger.info("📡 L1 invalidation listener started")
+
+    while True:
+        pubsub = valkey_client.pubsub()
+        try:
+            await pubsub.subscribe(L1_INVALIDATION_CHANNEL)
+
+            # Anything may have changed while we were not subscribed
+            l1_cache.clear()
+
+            while True:
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                if not message:
+                    continue
+                node_id, keys = json.loads(message["data"])
+                if node_id != NODE_ID:
+                    l1_cache.delete(*keys)
+
+        except asyncio.CancelledError:
+            logger.info("📡 L1 invalidation listener stopped")
+            raise
+        except Exception as e:
+            logger.error(f"❌ L1 invalidation listener error: {e}")
+            l1_cache.clear()
+            await asyncio.sleep(5)
+        finally:
+            try:
+                await pubsub.aclose()
+            except Exception:
+                pass
+
 # SESSION STORAGE FUNCTIONS
 async def save_user_session(user_id: int, session_data: dict):
     """Save user session data to Valkey"""
-    if not valkey_client:
+    if not valkey_ready():
         return False
 
     try:
-        key = f"session:{user_id}"
-        await valkey_client.setex(
-            key,
-            SESSION_TTL,
-            json.dumps(session_data)
-        )
+        await set_user_fields(user_id, {"session": encode_value(session_data)})
         logger.debug(f"💾 Session saved for user {user_id}")
         return True
     except Exception as e:
@@ -857,14 +1806,13 @@ async def save_user_session(user_id: int, session_data: dict):
 
 async def get_user_session(user_id: int) -> dict:
     """Get user session data from Valkey"""
-    if not valkey_client:
+    if not valkey_ready():
         return {}
 
     try:
-        key = f"session:{user_id}"
-        data = await valkey_client.get(key)
+        data = await valkey_raw.hget(user_key(user_id), "session")
         if data:
-            return json.loads(data)
+            return decode_value(data)
         return {}
     except Exception as e:
         logger.error(f"❌ Failed to get session for user {user_id}: {e}")
@@ -872,12 +1820,11 @@ async def get_user_session(user_id: int) -> dict:
 
 async def delete_user_session(user_id: int):
     """Delete user session from Valkey"""
-    if not valkey_client:
+    if not valkey_ready():
         return False
 
     try:
-        key = f"session:{user_id}"
-        await valkey_client.delete(key)
+        await valkey_raw.hdel(user_key(user_id), "session")
         logger.debug(f"🗑️ Session deleted for user {user_id}")
         return True
     except Exception as e:
@@ -885,15 +1832,26 @@ async def delete_user_session(user_id: int):
         return False
 
 # CACHING FUNCTIONS
+def decode_cache_value(value) -> any:
+    """Decode a raw cache value (codec or legacy JSON if possible)"""
+    if not value:
+        return None
+    try:
+        return decode_value(value)
+    except:
+        return value.decode(errors="replace") if isinstance(value, bytes) else value
+
 async def cache_set(key: str, value: any, ttl: int = CACHE_TTL):
     """Set cache value in Valkey"""
-    if not valkey_client:
+    if not valkey_ready():
         return False
 
     try:
-        if isinstance(value, (dict, list)):
-            value = json.dumps(value)
-        await valkey_client.setex(f"cache:{key}", ttl, value)
+        pipe = valkey_raw.pipeline(transaction=False)
+        pipe.setex(f"cache:{key}", ttl, encode_value(value, compress=True))
+        queue_invalidation(pipe, f"cache:{key}")
+        await pipe.execute()
+        l1_cache.set(f"cache:{key}", value, ttl)
         logger.debug(f"📦 Cache set for key: {key}")
         return True
     except Exception as e:
@@ -902,47 +1860,243 @@ async def cache_set(key: str, value: any, ttl: int = CACHE_TTL):
 
 async def cache_get(key: str) -> any:
     """Get cache value from Valkey"""
-    if not valkey_client:
+    if not valkey_ready():
         return None
 
+    cached = l1_cache.get(f"cache:{key}")
+    if cached is not None:
+        return cached
+
     try:
-        value = await valkey_client.get(f"cache:{key}")
-        if value:
-            try:
-                return json.loads(value)
-            except:
-                return value
-        return None
+        pipe = valkey_raw.pipeline(transaction=False)
+        pipe.ttl(f"cache:{key}")
+        pipe.get(f"cache:{key}")
+        ttl, raw_value = await pipe.execute()
+        value = decode_cache_value(raw_value)
+        if value is not None and ttl > 0:
+            l1_cache.set(f"cache:{key}", value, ttl)
+        return value
     except Exception as e:
         logger.error(f"❌ Failed to get cache for key {key}: {e}")
         return None
 
-async def cache_delete(key: str):
-    """Delete cache value from Valkey"""
-    if not valkey_client:
+async def cache_delete(*keys: str):
+    """Delete one or more cache values from Valkey"""
+    if not valkey_ready() or not keys:
+        return False
+
+    cache_keys = [f"cache:{key}" for key in keys]
+    try:
+        pipe = valkey_raw.pipeline(transaction=False)
+        pipe.delete(*cache_keys)
+        queue_invalidation(pipe, *cache_keys)
+        await pipe.execute()
+        l1_cache.delete(*cache_keys)
+        logger.debug(f"🗑️ Cache deleted for keys: {', '.join(keys)}")
+        return True
+    except Exception as e:
+        logger.error(f"❌ Failed to delete cache for keys {', '.join(keys)}: {e}")
+        return False
+
+def decode_cached_response(value) -> Optional[str]:
+    """Decode a cached response value"""
+    if not value:
+        return None
+    try:
+        return decode_value(value)
+    except Exception:
+        return None
+
+async def get_cached_response(user_id: int, field: str) -> Optional[str]:
+    """Get a cached Gemini response for the user"""
+    if not valkey_ready():
+        return None
+
+    # Use the value prefetched for this update if there is one
+    state = current_update_state.get()
+    if state and state.user_id == user_id and field in state.cache:
+        return state.cache[field]
+
+    cached = l1_cache.get(f"resp:{user_id}:{field}")
+    if cached is not None:
+        return cached
+
+    try:
+        response = decode_cached_response(await valkey_raw.get(user_response_key(user_id, field)))
+        if response is not None:
+            l1_cache.set(f"resp:{user_id}:{field}", response, CACHE_TTL)
+        return response
+    except Exception as e:
+        logger.error(f"❌ Failed to get cached response for user {user_id}: {e}")
+        return None
+
+async def cache_response(user_id: int, field: str, response: str, ttl: int = CACHE_TTL):
+    """Cache a Gemini response for the user under its own TTL"""
+    if not valkey_ready():
         return False
 
+    key = user_response_key(user_id, field)
+    value = encode_value(response, compress=True)
+
+    # Same question, same answer: replicas holding an older copy need no invalidation
+    l1_cache.set(f"resp:{user_id}:{field}", response, ttl)
+
+    # Buffer the write when handling an update
+    state = current_update_state.get()
+    if state and state.user_id == user_id:
+        state.cache[field] = response
+        state.queue(lambda pipe: pipe.setex(key, ttl, value))
+        return True
+
     try:
-        await valkey_client.delete(f"cache:{key}")
-        logger.debug(f"🗑️ Cache deleted for key: {key}")
+        await valkey_raw.setex(key, ttl, value)
+        logger.debug(f"📦 Response cached for user {user_id}")
         return True
     except Exception as e:
-        logger.error(f"❌ Failed to delete cache for key {key}: {e}")
+        logger.error(f"❌ Failed to cache response for user {user_id}: {e}")
+        return False
+
+# ACTIVITY ROLLUPS
+# Distinct active users go into one HyperLogLog per hour ({active_users}:<hour since epoch>),
+# so "last 24 hours" is a PFCOUNT over 24 keys. The shared {active_users} hash tag keeps
+# them in one cluster slot for that multi-key PFCOUNT. IDs are buffered in process and
+# flushed with one PFADD every ACTIVITY_FLUSH_INTERVAL seconds.
+def active_users_key(hour: int) -> str:
+    """Get the HyperLogLog key for an hour since the epoch"""
+    return f"{{active_users}}:{hour}"
+
+def record_active_user(user_id: int):
+    """Buffer a user for the current hour's active users rollup"""
+    active_users_pending.add(user_id)
+
+async def flush_active_users() -> bool:
+    """Add buffered users to the current hour's HyperLogLog"""
+    if not active_users_pending:
+        return True
+
+    if not valkey_ready():
+        # Keep the buffer bounded through a long outage
+        if len(active_users_pending) > ACTIVITY_BUFFER_MAX:
+            logger.warning(f"⚠️ Dropping {len(active_users_pending)} buffered active users, Valkey unavailable")
+            active_users_pending.clear()
         return False
 
+    user_ids_batch = list(active_users_pending)
+    active_users_pending.clear()
+    key = active_users_key(int(time.time() // 3600))
+    try:
+        pipe = valkey_raw.pipeline(transaction=False)
+        pipe.pfadd(key, *user_ids_batch)
+        pipe.expire(key, 25 * 3600)
+        await pipe.execute()
+        return True
+    except Exception as e:
+        logger.error(f"❌ Failed to flush active users: {e}")
+        active_users_pending.update(user_ids_batch)
+        return False
+
+async def count_recent_active_users(hours: int = 24) -> Optional[int]:
+    """Estimate distinct active users over the last hours (None without Valkey)"""
+    await flush_active_users()
+    if not valkey_ready():
+        return None
+
+    current_hour = int(time.time() // 3600)
+    try:
+        return await valkey_raw.pfcount(*(active_users_key(current_hour - i) for i in range(hours)))
+    except Exception as e:
+        logger.error(f"❌ Failed to count active users: {e}")
+        return None
+
+async def activity_flusher():
+    """Periodically flush buffered active users to Valkey"""
+    while True:
+        try:
+            await asyncio.sleep(ACTIVITY_FLUSH_INTERVAL)
+            await flush_active_users()
+        except asyncio.CancelledError:
+            await flush_active_users()
+            raise
+        except Exception as e:
+            logger.error(f"❌ Error in activity flusher: {e}")
+
+
+# MEDIA FILE ID CACHE
+async def get_cached_file_id(url: str) -> Optional[str]:
+    """Get Telegram file_id for a media URL (memory + Valkey)"""
+    file_id = media_file_ids.get(url)
+    if file_id:
+        return file_id
+
+    if valkey_ready():
+        try:
+            file_id = await valkey_client.hget("media_file_ids", url)
+            if file_id:
+                media_file_ids[url] = file_id
+                return file_id
+        except Exception as e:
+            logger.error(f"❌ Failed to get file_id for {url}: {e}")
+
+    return None
+
+async def save_file_id(url: str, file_id: str):
+    """Save Telegram file_id for a media URL (memory + Valkey)"""
+    media_file_ids[url] = file_id
+
+    if valkey_ready():
+        try:
+            await valkey_client.hset("media_file_ids", url, file_id)
+            logger.debug(f"📦 File id cached for {url}")
+        except Exception as e:
+            logger.error(f"❌ Failed to save file_id for {url}: {e}")
+
+async def forget_file_id(url: str):
+    """Drop a stale file_id so the next send uploads from the URL again"""
+    media_file_ids.pop(url, None)
+    logger.warning(f"⚠️ Cached file_id for {url} is stale, re-uploading")
+
+    if valkey_ready():
+        try:
+            await valkey_client.hdel("media_file_ids", url)
+        except Exception as e:
+            logger.error(f"❌ Failed to delete file_id for {url}: {e}")
+
+def is_stale_file_id(result: dict) -> bool:
+    """Check if a failed Bot API result was caused by an unusable file_id"""
+    return 'file' in str(result.get('description', '')).lower()
+
+async def remember_sent_photo(url: Optional[str], payload: dict, message: dict):
+    """Capture the file_id of a photo that was just uploaded from a URL"""
+    if not url or payload.get('photo') != url:
+        return
+
+    photos = message.get('photo') or []
+    if photos:
+        await save_file_id(url, photos[-1]['file_id'])
+
 # USER STATE MANAGEMENT
 async def save_user_state(user_id: int, state_data: dict):
-    """Save user state (help_expanded, broadcast_mode, etc.) to Valkey"""
-    if not valkey_client:
+    """Save user state fields (help_expanded, broadcast_mode, etc.) to Valkey"""
+    if not valkey_ready():
         return False
 
+    if not state_data:
+        return True
+
     try:
-        key = f"user_state:{user_id}"
-        await valkey_client.setex(
-            key,
-            SESSION_TTL,
-            json.dumps(state_data)
-        )
+        pipe = valkey_raw.pipeline(transaction=False)
+        pipe.hset(user_key(user_id), mapping={f"state:{name}": encode_value(value) for name, value in state_data.items()})
+        touch_user_keys(pipe, user_id)
+        queue_invalidation(pipe, f"help:{user_id}", f"state:{user_id}")
+        await pipe.execute()
+
+        # Write through to L1
+        cached_state = l1_cache.get(f"state:{user_id}")
+        if cached_state is not None:
+            l1_cache.set(f"state:{user_id}", {**cached_state, **state_data}, SESSION_TTL)
+        if "help_expanded" in state_data:
+            l1_cache.set(f"help:{user_id}", state_data["help_expanded"], SESSION_TTL)
+
         logger.debug(f"💾 User state saved for user {user_id}")
         return True
     except Exception as e:
@@ -951,15 +2105,23 @@ async def save_user_state(user_id: int, state_data: dict):
 
 async def get_user_state(user_id: int) -> dict:
     """Get user state from Valkey"""
-    if not valkey_client:
+    if not valkey_ready():
         return {}
 
+    cached_state = l1_cache.get(f"state:{user_id}")
+    if cached_state is not None:
+        return dict(cached_state)
+
     try:
-        key = f"user_state:{user_id}"
-        data = await valkey_client.get(key)
-        if data:
-            return json.loads(data)
-        return {}
+        data = await valkey_raw.hgetall(user_key(user_id))
+        user_state = {
+            field[len(b"state:"):].decode(): decode_value(value)
+            for field, value in data.items()
+            if field.startswith(b"state:")
+        }
+        if user_state:
+            l1_cache.set(f"state:{user_id}", user_state, SESSION_TTL)
+        return dict(user_state)
     except Exception as e:
         logger.error(f"❌ Failed to get user state for user {user_id}: {e}")
         return {}
@@ -971,24 +2133,115 @@ async def update_help_expanded_state(user_id: int, expanded: bool):
     # Update memory
     help_expanded[user_id] = expanded
 
-    # Update Valkey
-    if valkey_client:
-        state = await get_user_state(user_id)
-        state['help_expanded'] = expanded
-        await save_user_state(user_id, state)
+    # Update Valkey - a single field write, replayed on rehydrate if it cannot be written now
+    if valkey_client and not await save_user_state(user_id, {'help_expanded': expanded}):
+        help_expanded_dirty.add(user_id)
 
 async def get_help_expanded_state(user_id: int) -> bool:
     """Get help expanded state from Valkey with memory fallback"""
     # Try Valkey first
-    if valkey_client:
-        state = await get_user_state(user_id)
-        if 'help_expanded' in state:
-            return state['help_expanded']
+    if valkey_ready():
+        cached = l1_cache.get(f"help:{user_id}")
+        if cached is not None:
+            return cached
+
+        try:
+            value = await valkey_raw.hget(user_key(user_id), "state:help_expanded")
+            if value is not None:
+                expanded = decode_value(value)
+                l1_cache.set(f"help:{user_id}", expanded, SESSION_TTL)
+                return expanded
+        except Exception as e:
+            logger.error(f"❌ Failed to get help state for user {user_id}: {e}")
 
     # Fallback to memory
     return help_expanded.get(user_id, False)
 
 # RATE LIMITING FUNCTIONS
+# Atomic rate limit decision: returns {status, hard_limit_ttl_ms}
+# status 0 = process, 1 = ignore, 2 = hard-limited
+RATE_LIMIT_LUA = """
+local ttl = redis.call('PTTL', KEYS[1])
+if ttl > 0 then
+    return {2, ttl}
+end
+local count = redis.call('INCR', KEYS[2])
+if count == 1 then
+    redis.call('PEXPIRE', KEYS[2], ARGV[1])
+end
+if count > tonumber(ARGV[2]) then
+    redis.call('SET', KEYS[1], '1', 'EX', ARGV[3])
+    return {2, tonumber(ARGV[3]) * 1000}
+end
+if count > 1 then
+    return {1, 0}
+end
+return {0, 0}
+"""
+
+async def load_rate_limit_script():
+    """Load the rate limit script into Valkey once at startup"""
+    global rate_limit_script
+
+    if not valkey_ready():
+        return False
+
+    try:
+        rate_limit_script = valkey_client.register_script(RATE_LIMIT_LUA)
+        await valkey_client.script_load(RATE_LIMIT_LUA)
+        logger.info("✅ Rate limit script loaded into Valkey")
+        return True
+    except Exception as e:
+        logger.error(f"❌ Failed to load rate limit script: {e}")
+        rate_limit_script = None
+        return False
+
+def is_shadow_hard_limited(user_id: int, chat_id: int) -> bool:
+    """Check the in-process shadow cache of hard-limited user/chat pairs"""
+    shadow_key = (user_id, chat_id)
+    hard_until = hard_limit_shadow.get(shadow_key)
+    if hard_until:
+        if time.time() < hard_until:
+            return True
+        del hard_limit_shadow[shadow_key]
+    return False
+
+def rate_limit_keys(user_id: int, chat_id: int) -> list:
+    """Get the hard limit flag and counter keys of a user/chat pair"""
+    return [f"user:{{{user_id}}}:hard:{chat_id}", f"user:{{{user_id}}}:count:{chat_id}"]
+
+def rate_limit_args() -> list:
+    """Get the rate limit script arguments: window ms, max count, hard limit seconds"""
+    return [int(MESSAGE_LIMIT * 1000), RATE_LIMIT_COUNT, RATE_LIMIT_TTL]
+
+def run_rate_limit_script(user_id: int, chat_id: int):
+    """Run the rate limit script directly"""
+    return rate_limit_script(keys=rate_limit_keys(user_id, chat_id), args=rate_limit_args())
+
+def queue_rate_limit_script(pipe, user_id: int, chat_id: int):
+    """Queue the rate limit script on a pipeline as a bare EVALSHA
+
+    Passing the Script object to a pipeline would register it there, and execute()
+    would then send a SCRIPT EXISTS round trip first. The script is loaded at startup;
+    a NoScriptError means Valkey lost it and the caller reloads it.
+    """
+    pipe.evalsha(rate_limit_script.sha, 2, *rate_limit_keys(user_id, chat_id), *rate_limit_args())
+
+def apply_rate_limit_result(user_id: int, chat_id: int, result) -> bool:
+    """Turn a rate limit script result into a decision, remembering hard limits locally"""
+    status, hard_ttl_ms = int(result[0]), int(result[1])
+
+    if status == 2:
+        # Hard rate limit - remember locally until it expires
+        if len(hard_limit_shadow) > 10000:
+            now = time.time()
+            for key in [k for k, until in hard_limit_shadow.items() if until <= now]:
+                del hard_limit_shadow[key]
+        hard_limit_shadow[(user_id, chat_id)] = time.time() + hard_ttl_ms / 1000
+        return True # Ignore and hard limit
+
+    return status == 1 # Ignore subsequent messages, otherwise process
+
 async def is_rate_limited(user_id: int, chat_id: int) -> bool:
     """
     Checks if a user is rate-limited based on a per-user, per-chat basis.
@@ -997,74 +2250,394 @@ async def is_rate_limited(user_id: int, chat_id: int) -> bool:
     - Ignores messages 2-5 within the same second without a hard limit.
     - Hard rate-limits (60s) if more than 5 messages are sent in one second.
     """
+    # Known spammers are answered from the in-process shadow cache
+    if is_shadow_hard_limited(user_id, chat_id):
+        return True
+
     # Use Valkey if available
-    if valkey_client:
+    if valkey_ready() and rate_limit_script:
         try:
-            hard_limit_key = f"hard_rate_limit:{user_id}:{chat_id}"
-            if await valkey_client.exists(hard_limit_key):
-                return True
+            result = await run_rate_limit_script(user_id, chat_id)
+            return apply_rate_limit_result(user_id, chat_id, result)
+
+        except Exception as e:
+            logger.error(f"❌ Valkey rate limit check failed for user {user_id}:{chat_id}: {e}. Falling back to memory.")
+            # Fallback to memory if Valkey fails
+            pass
 
-            message_count_key = f"message_count:{user_id}:{chat_id}"
+    # In-memory fallback logic
+    return memory_rate_limiter.check(user_id, chat_id)
+
+class MemoryRateLimiter:
+    """Bounded per user/chat sliding-window limiter used while Valkey is unavailable"""
+
+    def __init__(self, window: float, max_count: int, hard_ttl: int, max_keys: int):
+        self.window = window
+        self.max_count = max_count
+        self.hard_ttl = hard_ttl
+        self.max_keys = max_keys
+        self.slots = max_count + 1
+
+        # Per (user_id, chat_id): array('d') [hard_until, next_slot, ts_0 .. ts_<slots-1>]
+        # kept in least recently used order
+        self.entries: OrderedDict = OrderedDict()
+        self.template = array('d', [0.0, 0.0] + [float("-inf")] * self.slots)
+
+    def check(self, user_id: int, chat_id: int, current_time: float = None) -> bool:
+        """Record a message and decide: False = process, True = ignore (and maybe hard limit)"""
+        current_time = time.time() if current_time is None else current_time
+        entries = self.entries
+
+        key = (user_id, chat_id)
+        entry = entries.get(key)
+        if entry is None:
+            # New pairs pay for the upkeep: idle sweep and size cap
+            self.sweep(current_time)
+            entry = entries[key] = array('d', self.template)
+            if len(entries) > self.max_keys:
+                entries.popitem(last=False)
+        else:
+            entries.move_to_end(key)
+
+        # Check for hard limit
+        if current_time < entry[0]:
+            return True
 
-            pipe = valkey_client.pipeline()
-            pipe.incr(message_count_key)
-            pipe.ttl(message_count_key)
-            results = await pipe.execute()
+        # Overwrite the oldest of the last max_count + 1 timestamps
+        slot = int(entry[1])
+        entry[2 + slot] = current_time
+        entry[1] = (slot + 1) % self.slots
 
-            count = results[0]
-            ttl = results[1]
+        threshold = current_time - self.window
+        count = 0
+        for ts in entry[2:]:
+            if ts > threshold:
+                count += 1
 
-            if ttl == -1:
-                # Key was just created, set expiry
-                await valkey_client.expire(message_count_key, int(MESSAGE_LIMIT))
+        if count > self.max_count:
+            # Hard rate limit
+            entry[0] = current_time + self.hard_ttl
+            return True # Ignore and hard limit
 
-            if count > RATE_LIMIT_COUNT:
-                # Hard rate limit
-                await valkey_client.setex(hard_limit_key, RATE_LIMIT_TTL, "1")
-                return True # Ignore and hard limit
+        return count > 1 # Ignore subsequent messages, otherwise process
+
+    def sweep(self, current_time: float, limit: int = 2):
+        """Drop a few idle entries from the least recently used end"""
+        for _ in range(limit):
+            if not self.entries:
+                return
+
+            key, entry = next(iter(self.entries.items()))
+            last_seen = entry[2 + (int(entry[1]) - 1) % self.slots]
+            if max(last_seen + self.window, entry[0]) > current_time:
+                return
+            del self.entries[key]
 
-            if count > 1:
-                return True # Ignore subsequent messages
+memory_rate_limiter = MemoryRateLimiter(MESSAGE_LIMIT, RATE_LIMIT_COUNT, RATE_LIMIT_TTL, RATE_LIMIT_MAX_KEYS)
 
-            return False # Process this message
+# REQUEST-SCOPED VALKEY STATE
+class UpdateState:
+    """Valkey state for one update: reads prefetched up front, writes buffered until the end"""
 
+    def __init__(self, user_id: int, chat_id: int):
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.rate_limited = False
+        self.history: Optional[list] = None
+        self.pending_history: list = []
+        self.cache: Dict[str, any] = {}
+        self.writes: list = []
+
+    def queue(self, write) -> None:
+        """Buffer a write - `write` is called with the flush pipeline"""
+        self.writes.append(write)
+
+
+# State of the update being handled by the current task
+current_update_state: contextvars.ContextVar = contextvars.ContextVar("current_update_state", default=None)
+
+def get_response_cache_key(user_id: int, user_message: str) -> Optional[str]:
+    """Get the response cache field for short messages whose responses may be cached"""
+    if not user_id or len(user_message) > 50:
+        return None
+
+    return f"resp:{hashlib.md5(user_message.lower().encode()).hexdigest()}"
+
+async def prefetch_update_state(user_id: int, chat_id: int, user_message: str = None) -> UpdateState:
+    """Fetch rate limit decision, history and response cache for an update in one pipeline"""
+    state = UpdateState(user_id, chat_id)
+
+    if is_shadow_hard_limited(user_id, chat_id):
+        state.rate_limited = True
+        return state
+
+    if valkey_ready() and rate_limit_script:
+        cache_key = get_response_cache_key(user_id, user_message) if user_message else None
+
+        # Reads already in L1 are left out of the pipeline
+        history = l1_cache.get(f"history:{user_id}")
+        cached_response = l1_cache.get(f"resp:{user_id}:{cache_key}") if cache_key else None
+
+        try:
+            pipe = valkey_raw.pipeline(transaction=False)
+            queue_rate_limit_script(pipe, user_id, chat_id)
+            if history is None:
+                pipe.lrange(user_history_key(user_id), 0, -1)
+            if cache_key and cached_response is None:
+                pipe.get(user_response_key(user_id, cache_key))
+            results = iter(await pipe.execute())
+
+            state.rate_limited = apply_rate_limit_result(user_id, chat_id, next(results))
+
+            if history is None:
+                history = [decode_history_message(item) for item in next(results)]
+                if history:
+                    l1_cache.set(f"history:{user_id}", history, SESSION_TTL)
+            state.history = history
+
+            if cache_key:
+                if cached_response is None:
+                    cached_response = decode_cached_response(next(results))
+                    if cached_response is not None:
+                        l1_cache.set(f"resp:{user_id}:{cache_key}", cached_response, CACHE_TTL)
+                state.cache[cache_key] = cached_response
+
+            logger.debug(f"📦 Prefetched update state for user {user_id}")
+            return state
+
+        except valkey.exceptions.NoScriptError:
+            # Valkey restarted or flushed scripts - load it again for the next update
+            logger.warning("⚠️ Rate limit script missing from Valkey, reloading")
+            await load_rate_limit_script()
         except Exception as e:
-            logger.error(f"❌ Valkey rate limit check failed for user {user_id}:{chat_id}: {e}. Falling back to memory.")
-            # Fallback to memory if Valkey fails
-            pass
+            logger.error(f"❌ Failed to prefetch update state for user {user_id}: {e}")
 
-    # In-memory fallback logic
-    key = f"{user_id}:{chat_id}"
-    current_time = time.time()
+    # Fallback: plain rate limit check, helpers use their own paths
+    state.rate_limited = await is_rate_limited(user_id, chat_id)
+    return state
 
-    # Check for hard limit
-    if key in rate_limited_users and current_time < rate_limited_users[key]:
-        return True
-    elif key in rate_limited_users:
-        # Clean up expired hard limit
-        del rate_limited_users[key]
+async def flush_update_state(state: UpdateState):
+    """Write all buffered Valkey writes of an update in one pipeline"""
+    if not state.writes or not valkey_client:
+        return
+
+    try:
+        pipe = valkey_raw.pipeline(transaction=False)
+        for write in state.writes:
+            write(pipe)
+        await pipe.execute()
+        logger.debug(f"💾 Flushed {len(state.writes)} buffered writes for user {state.user_id}")
 
-    # Get message timestamps for the user-chat combo
-    timestamps = user_message_counts.get(key, [])
+    except Exception as e:
+        logger.error(f"❌ Failed to flush update state for user {state.user_id}: {e}")
 
-    # Filter out timestamps older than our window (1 second)
-    timestamps = [ts for ts in timestamps if current_time - ts < MESSAGE_LIMIT]
+        # Keep conversation in memory so the next reply still has context
+        if state.pending_history:
+            history = conversation_history.setdefault(state.user_id, [])
+            history.extend(state.pending_history)
+            conversation_history[state.user_id] = history[-CHAT_LENGTH:]
 
-    # Add current message timestamp
-    timestamps.append(current_time)
-    user_message_counts[key] = timestamps
+# COMPACT ID STORE
+ID_CHUNK_SIZE = 1000
 
-    count = len(timestamps)
+class IdSet:
+    """Compact set of Telegram IDs: sorted array('q') plus small add/remove buffers merged in periodically"""
 
-    if count > RATE_LIMIT_COUNT:
-        # Hard rate limit
-        rate_limited_users[key] = current_time + RATE_LIMIT_TTL
-        return True # Ignore and hard limit
+    def __init__(self, ids=()):
+        # Dedupe the sorted run directly, a temporary set of every ID would defeat the compact layout
+        self.ids = array('q', (value for value, _ in groupby(sorted(ids))))
+        self.added: Set[int] = set()
+        self.removed: Set[int] = set()
 
-    if count > 1:
-        return True # Ignore subsequent messages
+    def in_sorted(self, value: int) -> bool:
+        """Binary search the sorted array"""
+        index = bisect.bisect_left(self.ids, value)
+        return index < len(self.ids) and self.ids[index] == value
 
-    return False # Process this message
+    def __contains__(self, value: int) -> bool:
+        if value in self.added:
+            return True
+        if value in self.removed:
+            return False
+        return self.in_sorted(value)
+
+    def __len__(self) -> int:
+        return len(self.ids) - len(self.removed) + len(self.added)
+
+    def __iter__(self):
+        return self.iter_chunked()
+
+    def add(self, value: int):
+        """Add an ID"""
+        if value in self.removed:
+            self.removed.discard(value)
+        elif not self.in_sorted(value):
+            self.added.add(value)
+            self.maybe_merge()
+
+    def remove(self, value: int):
+        """Remove an ID (no error if missing)"""
+        if value in self.added:
+            self.added.discard(value)
+        elif self.in_sorted(value):
+            self.removed.add(value)
+            self.maybe_merge()
+
+    def update(self, values):
+        """Add many IDs at once with a linear merge of both sorted arrays"""
+        if values is self:
+            return
+        other = values if isinstance(values, IdSet) else IdSet(values)
+        self.merge()
+        other.merge()
+
+        merged = array('q')
+        last = None
+        for value in heapq.merge(self.ids, other.ids):
+            if value != last:
+                merged.append(value)
+                last = value
+        self.ids = merged
+
+    def maybe_merge(self):
+        """Merge the buffers once they grow past a fraction of the array"""
+        if len(self.added) + len(self.removed) > max(1024, len(self.ids) // 64):
+            self.merge()
+
+    def merge(self):
+        """Fold the buffers into a new sorted array"""
+        if not self.added and not self.removed:
+            return
+        removed = self.removed
+        self.ids = array('q', heapq.merge(
+            (value for value in self.ids if value not in removed),
+            sorted(self.added)
+        ))
+        self.added = set()
+        self.removed = set()
+
+    def iter_chunked(self, chunk_size: int = ID_CHUNK_SIZE):
+        """Iterate IDs a chunk at a time from a snapshot, safe against concurrent changes"""
+        # The array is replaced on merge, never changed in place; the buffers are copied
+        ids, added, removed = self.ids, list(self.added), set(self.removed)
+        for start in range(0, len(ids), chunk_size):
+            chunk = [value for value in ids[start:start + chunk_size] if value not in removed]
+            yield from chunk
+        yield from added
+
+    def nbytes(self) -> int:
+        """Approximate memory held by the store"""
+        return (
+            sys.getsizeof(self.ids)
+            + sys.getsizeof(self.added) + 28 * len(self.added)
+            + sys.getsizeof(self.removed) + 28 * len(self.removed)
+        )
+
+user_ids = IdSet()
+group_ids = IdSet()
+
+# KNOWN ID FILTER
+# ID_STARTUP_MODE=bloom: instead of loading every ID at boot, a Bloom filter of all
+# known user and group IDs (groups are negative, so one filter holds both) is
+# restored from BLOOM_SNAPSHOT_PATH or streamed from the DB in the background.
+# user_ids/group_ids then only hold IDs seen by this process, and counts come
+# from Postgres planner estimates.
+class BloomFilter:
+    """Bloom filter over 64-bit IDs: no false negatives, BLOOM_ERROR_RATE false positives at capacity"""
+
+    MAGIC = b"SKBF"
+    HEADER = struct.Struct("<4sQQQ")
+
+    def __init__(self, capacity: int, error_rate: float = BLOOM_ERROR_RATE, size: int = None, hashes: int = None):
+        self.size = size or max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = hashes or max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    @property
+    def capacity(self) -> int:
+        """Number of IDs the filter holds at its target error rate"""
+        return int(self.size * math.log(2) ** 2 / -math.log(BLOOM_ERROR_RATE))
+
+    def positions(self, value: int):
+        """Bit positions of an ID (double hashing over one blake2b digest)"""
+        digest = hashlib.blake2b(value.to_bytes(8, "little", signed=True), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, value: int):
+        """Add an ID"""
+        for position in self.positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value: int) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(value))
+
+    def save(self, path: str):
+        """Write a snapshot atomically"""
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "wb") as snapshot:
+            snapshot.write(self.HEADER.pack(self.MAGIC, self.size, self.hashes, self.count))
+            snapshot.write(self.bits)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "BloomFilter":
+        """Read a snapshot written by save()"""
+        with open(path, "rb") as snapshot:
+            magic, size, hashes, count = cls.HEADER.unpack(snapshot.read(cls.HEADER.size))
+            if magic != cls.MAGIC:
+                raise ValueError("not a Bloom filter snapshot")
+            bloom = cls(capacity=1, size=size, hashes=hashes)
+            bloom.bits = bytearray(snapshot.read())
+            bloom.count = count
+        if len(bloom.bits) != (size + 7) // 8:
+            raise ValueError("truncated Bloom filter snapshot")
+        return bloom
+
+id_filter: BloomFilter = None
+id_filter_ready = False
+id_filter_task = None
+user_count_estimate = 0
+group_count_estimate = 0
+
+def is_known_id(value: int, ids: IdSet) -> Optional[bool]:
+    """True/False when certain, None when the DB has to confirm (Bloom positive or filter still building)"""
+    if value in ids:
+        return True
+    if id_filter is None:
+        return False
+    if not id_filter_ready:
+        return None
+    return None if value in id_filter else False
+
+def remember_id(value: int, ids: IdSet):
+    """Record an ID in the memory store and the Bloom filter"""
+    ids.add(value)
+    if id_filter is not None:
+        id_filter.add(value)
+
+def count_users() -> int:
+    """Known users: exact in full mode, Postgres estimate in bloom mode"""
+    if ID_STARTUP_MODE == "bloom":
+        return max(user_count_estimate, len(user_ids))
+    return len(user_ids)
+
+def count_groups() -> int:
+    """Known groups: exact in full mode, Postgres estimate in bloom mode"""
+    if ID_STARTUP_MODE == "bloom":
+        return max(group_count_estimate, len(group_ids))
+    return len(group_ids)
+
+def format_bytes(size: int) -> str:
+    """Human readable byte size"""
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return f"{size:.0f}{unit}" if unit == "B" else f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}GB"
 
 # DATABASE FUNCTIONS
 async def init_database():
@@ -1129,6 +2702,62 @@ async def init_database():
             await conn.execute("CREATE INDEX IF NOT EXISTS idx_purchases_user_id ON purchases(user_id)")
             await conn.execute("CREATE INDEX IF NOT EXISTS idx_purchases_created_at ON purchases(created_at)")
 
+            # Running totals per buyer, maintained with each purchase insert
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS buyer_totals (
+                    user_id BIGINT PRIMARY KEY,
+                    username TEXT,
+                    first_name TEXT,
+                    last_name TEXT,
+                    total_amount BIGINT NOT NULL DEFAULT 0,
+                    purchase_count INTEGER NOT NULL DEFAULT 0,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            # Matches the leaderboard order so keyset pages are plain index range scans
+            await conn.execute("CREATE INDEX IF NOT EXISTS idx_buyer_totals_rank ON buyer_totals(total_amount DESC, user_id)")
+
+            # Running purchase totals and hourly purchase rollups for /stats
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS purchase_totals (
+                    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+                    total_purchases BIGINT NOT NULL DEFAULT 0,
+                    total_revenue BIGINT NOT NULL DEFAULT 0
+                )
+            """)
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS purchase_hourly (
+                    hour TIMESTAMP PRIMARY KEY,
+                    purchases INTEGER NOT NULL DEFAULT 0,
+                    revenue BIGINT NOT NULL DEFAULT 0
+                )
+            """)
+            if not await conn.fetchval("SELECT EXISTS(SELECT 1 FROM purchase_totals)"):
+                async with conn.transaction():
+                    await conn.execute("""
+                        INSERT INTO purchase_totals (id, total_purchases, total_revenue)
+                        SELECT TRUE, COUNT(*), COALESCE(SUM(amount), 0) FROM purchases
+                        ON CONFLICT (id) DO NOTHING
+                    """)
+                    await conn.execute("""
+                        INSERT INTO purchase_hourly (hour, purchases, revenue)
+                        SELECT date_trunc('hour', created_at), COUNT(*), SUM(amount)
+                        FROM purchases
+                        GROUP BY 1
+                        ON CONFLICT (hour) DO NOTHING
+                    """)
+
+            # Backfill from existing purchases the first time
+            if not await conn.fetchval("SELECT EXISTS(SELECT 1 FROM buyer_totals)"):
+                await conn.execute("""
+                    INSERT INTO buyer_totals (user_id, username, first_name, last_name, total_amount, purchase_count)
+                    SELECT DISTINCT ON (user_id) user_id, username, first_name, last_name,
+                        SUM(amount) OVER (PARTITION BY user_id), COUNT(*) OVER (PARTITION BY user_id)
+                    FROM purchases
+                    ORDER BY user_id, created_at DESC
+                    ON CONFLICT (user_id) DO NOTHING
+                """)
+
         logger.info("✅ Database tables created/verified successfully")
 
         # Load existing users and groups into memory
@@ -1148,100 +2777,322 @@ async def load_data_from_database():
         logger.warning("⚠️ Database pool not available for loading data")
         return
 
+    if ID_STARTUP_MODE == "bloom":
+        await load_id_filter()
+        return
+
     try:
         async with db_pool.acquire() as conn:
             # Load user IDs
             user_rows = await conn.fetch("SELECT user_id FROM users")
-            user_ids = {row['user_id'] for row in user_rows}
+            user_ids = IdSet(row['user_id'] for row in user_rows)
 
             # Load group IDs
             group_rows = await conn.fetch("SELECT group_id FROM groups")
-            group_ids = {row['group_id'] for row in group_rows}
+            group_ids = IdSet(row['group_id'] for row in group_rows)
 
         logger.info(f"✅ Loaded {len(user_ids)} users and {len(group_ids)} groups from database")
 
     except Exception as e:
         logger.error(f"❌ Failed to load data from database: {e}")
 
+# WRITE-BEHIND UPSERTS
+USER_UPSERT_SQL = """
+    INSERT INTO users (user_id, username, first_name, last_name, updated_at)
+    SELECT user_id, username, first_name, last_name, CURRENT_TIMESTAMP
+    FROM unnest($1::bigint[], $2::text[], $3::text[], $4::text[])
+        AS batch(user_id, username, first_name, last_name)
+    ON CONFLICT (user_id)
+    DO UPDATE SET
+        username = EXCLUDED.username,
+        first_name = EXCLUDED.first_name,
+        last_name = EXCLUDED.last_name,
+        updated_at = CURRENT_TIMESTAMP
+"""
+
+GROUP_UPSERT_SQL = """
+    INSERT INTO groups (group_id, title, username, type, updated_at)
+    SELECT group_id, title, username, type, CURRENT_TIMESTAMP
+    FROM unnest($1::bigint[], $2::text[], $3::text[], $4::text[])
+        AS batch(group_id, title, username, type)
+    ON CONFLICT (group_id)
+    DO UPDATE SET
+        title = EXCLUDED.title,
+        username = EXCLUDED.username,
+        type = EXCLUDED.type,
+        updated_at = CURRENT_TIMESTAMP
+"""
+
+class UpsertBatcher:
+    """Coalesces upserts by primary key and writes the latest row of each in one statement per batch"""
+
+    def __init__(self, name: str, sql: str, max_rows: int, interval_ms: int):
+        self.name = name
+        self.sql = sql
+        self.max_rows = max_rows
+        self.interval = interval_ms / 1000
+        self.pending: Dict[int, tuple] = {}
+        self.written: Dict[int, int] = {}
+        self.wake = asyncio.Event()
+        self.flush_lock = asyncio.Lock()
+        self.task = None
+        self.stopping = False
+        self.rows_queued = 0
+        self.rows_skipped = 0
+        self.rows_written = 0
+
+    @staticmethod
+    def fingerprint(row: tuple, written_at: float) -> int:
+        """Pack a 32-bit hash of the row and the write time in minutes into one int"""
+        return (int(written_at // 60) << 32) | (hash(row) & 0xFFFFFFFF)
+
+    def is_unchanged(self, key: int, row: tuple, current_time: float) -> bool:
+        """Check if the row matches the last one written and is still within the refresh interval"""
+        written = self.written.get(key)
+        if written is None or (written & 0xFFFFFFFF) != (hash(row) & 0xFFFFFFFF):
+            return False
+        return current_time - (written >> 32) * 60 < UPSERT_REFRESH_INTERVAL
+
+    def add(self, key: int, row: tuple):
+        """Queue a row unless nothing changed, replacing any pending row for the same key"""
+        current_time = time.time()
+        if key not in self.pending and self.is_unchanged(key, row, current_time):
+            self.rows_skipped += 1
+            return
+
+        self.pending[key] = row
+        self.written[key] = self.fingerprint(row, current_time)
+        self.rows_queued += 1
+
+        if len(self.pending) >= self.max_rows:
+            self.wake.set()
+
+    def trim_fingerprints(self):
+        """Forget fingerprints past the refresh interval once the cache is over its cap"""
+        if len(self.written) <= UPSERT_FINGERPRINT_MAX:
+            return
+
+        cutoff = int((time.time() - UPSERT_REFRESH_INTERVAL) // 60)
+        self.written = {key: value for key, value in self.written.items() if value >> 32 > cutoff}
+        if len(self.written) > UPSERT_FINGERPRINT_MAX:
+            self.written.clear()
+
+    async def flush(self):
+        """Write all pending rows in one round trip"""
+        async with self.flush_lock:
+            if not self.pending or not db_pool:
+                return
+
+            batch, self.pending = self.pending, {}
+
+            # Sorted keys keep lock order stable across concurrent batches
+            rows = [batch[key] for key in sorted(batch)]
+            columns = [list(column) for column in zip(*rows)]
+
+            written = False
+            try:
+                async with db_pool.acquire() as conn:
+                    await conn.execute(self.sql, *columns)
+                written = True
+                self.rows_written += len(rows)
+                logger.debug(f"💾 Flushed {len(rows)} {self.name} upserts")
+                self.trim_fingerprints()
+
+            except Exception as e:
+                logger.error(f"❌ Failed to flush {len(rows)} {self.name} upserts: {e}")
+
+            finally:
+                # Put rows back unless a newer one arrived meanwhile (also on cancellation)
+                if not written:
+                    for key, row in batch.items():
+                        self.pending.setdefault(key, row)
+
+    async def run(self):
+        """Flush every interval, or as soon as a full batch is queued, until stopped"""
+        while not self.stopping:
+            try:
+                await asyncio.wait_for(self.wake.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wake.clear()
+            await self.flush()
+
+    def start(self):
+        """Start the background flush loop"""
+        if not self.task:
+            self.stopping = False
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """Stop the flush loop, letting an in-flight write finish, and write whatever is still pending"""
+        if self.task:
+            self.stopping = True
+            self.wake.set()
+            try:
+                await self.task
+            except Exception as e:
+                logger.error(f"❌ {self.name.capitalize()} upsert flush loop failed: {e}")
+            self.task = None
+        await self.flush()
+
+user_upserts = UpsertBatcher("user", USER_UPSERT_SQL, UPSERT_BATCH_SIZE, UPSERT_FLUSH_MS)
+group_upserts = UpsertBatcher("group", GROUP_UPSERT_SQL, UPSERT_BATCH_SIZE, UPSERT_FLUSH_MS)
+
 def save_user_to_database_async(user_id: int, username: str = None, first_name: str = None, last_name: str = None):
-    """Save user to database asynchronously (fire and forget)"""
+    """Queue a user upsert for the next batched write (coalesced per user)"""
     if not db_pool:
         return
 
-    async def save_user():
-        try:
-            async with db_pool.acquire() as conn:
-                await conn.execute("""
-                    INSERT INTO users (user_id, username, first_name, last_name, updated_at)
-                    VALUES ($1, $2, $3, $4, CURRENT_TIMESTAMP)
-                    ON CONFLICT (user_id)
-                    DO UPDATE SET
-                        username = EXCLUDED.username,
-                        first_name = EXCLUDED.first_name,
-                        last_name = EXCLUDED.last_name,
-                        updated_at = CURRENT_TIMESTAMP
-                """, user_id, username, first_name, last_name)
-
-            logger.debug(f"💾 User {user_id} saved to database")
+    user_upserts.add(user_id, (user_id, username, first_name, last_name))
+
+def save_group_to_database_async(group_id: int, title: str = None, username: str = None, chat_type: str = None):
+    """Queue a group upsert for the next batched write (coalesced per group)"""
+    if not db_pool:
+        return
+
+    group_upserts.add(group_id, (group_id, title, username, chat_type))
+
+async def refresh_id_count_estimates():
+    """Refresh user and group counts from planner statistics (no table scan)"""
+    global user_count_estimate, group_count_estimate
+
+    if not db_pool:
+        return
 
+    try:
+        async with db_pool.acquire() as conn:
+            rows = await conn.fetch("""
+                SELECT relname, reltuples::bigint AS estimate
+                FROM pg_class
+                WHERE relname IN ('users', 'groups') AND relkind = 'r'
+            """)
+        estimates = {row['relname']: max(row['estimate'], 0) for row in rows}
+        user_count_estimate = estimates.get('users', user_count_estimate)
+        group_count_estimate = estimates.get('groups', group_count_estimate)
+    except Exception as e:
+        logger.error(f"❌ Failed to get user/group count estimates: {e}")
+
+async def load_id_filter():
+    """Restore the known-ID Bloom filter from its snapshot, or stream it from the DB in the background"""
+    global id_filter, id_filter_ready, id_filter_task
+
+    await refresh_id_count_estimates()
+    expected = user_count_estimate + group_count_estimate
+
+    if os.path.exists(BLOOM_SNAPSHOT_PATH):
+        try:
+            bloom = BloomFilter.load(BLOOM_SNAPSHOT_PATH)
+            if bloom.capacity >= expected:
+                id_filter, id_filter_ready = bloom, True
+                logger.info(f"✅ Restored known-ID filter with {bloom.count} IDs from {BLOOM_SNAPSHOT_PATH}")
+                return
+            logger.info("🔄 Known-ID filter snapshot is over capacity, rebuilding")
         except Exception as e:
-            logger.error(f"❌ Failed to save user {user_id} to database: {e}")
+            logger.error(f"❌ Failed to restore known-ID filter: {e}")
 
-    # Schedule the save operation without waiting
-    asyncio.create_task(save_user())
+    # Room to grow before the error rate degrades
+    id_filter = BloomFilter(capacity=max(BLOOM_MIN_CAPACITY, expected * 2))
+    id_filter_ready = False
+    id_filter_task = asyncio.create_task(stream_ids_into_filter(id_filter))
 
-def save_group_to_database_async(group_id: int, title: str = None, username: str = None, chat_type: str = None):
-    """Save group to database asynchronously (fire and forget)"""
+async def stream_ids_into_filter(bloom: BloomFilter):
+    """Fill the Bloom filter from server-side cursors over users and groups"""
+    global id_filter_ready
+
+    try:
+        async with db_pool.acquire() as conn:
+            async with conn.transaction():
+                async for row in conn.cursor("SELECT user_id FROM users", prefetch=10000):
+                    bloom.add(row['user_id'])
+                async for row in conn.cursor("SELECT group_id FROM groups", prefetch=10000):
+                    bloom.add(row['group_id'])
+
+        id_filter_ready = bloom is id_filter
+        logger.info(f"✅ Known-ID filter built with {bloom.count} IDs ({format_bytes(len(bloom.bits))})")
+
+    except Exception as e:
+        logger.error(f"❌ Failed to build known-ID filter: {e}")
+
+def save_id_filter():
+    """Snapshot the known-ID filter for the next cold start"""
+    if id_filter is None or not id_filter_ready:
+        return
+
+    try:
+        id_filter.save(BLOOM_SNAPSHOT_PATH)
+        logger.info(f"💾 Known-ID filter saved to {BLOOM_SNAPSHOT_PATH}")
+    except Exception as e:
+        logger.error(f"❌ Failed to save known-ID filter: {e}")
+
+def confirm_new_id_async(value: int, table: str, column: str, message: str, user_info: Dict[str, any]):
+    """Check a Bloom filter positive against the DB and log the ID as new if it is not there (fire and forget)"""
     if not db_pool:
         return
 
-    async def save_group():
+    async def confirm():
         try:
             async with db_pool.acquire() as conn:
-                await conn.execute("""
-                    INSERT INTO groups (group_id, title, username, type, updated_at)
-                    VALUES ($1, $2, $3, $4, CURRENT_TIMESTAMP)
-                    ON CONFLICT (group_id)
-                    DO UPDATE SET
-                        title = EXCLUDED.title,
-                        username = EXCLUDED.username,
-                        type = EXCLUDED.type,
-                        updated_at = CURRENT_TIMESTAMP
-                """, group_id, title, username, chat_type)
-
-            logger.debug(f"💾 Group {group_id} saved to database")
-
+                exists = await conn.fetchval(f"SELECT EXISTS(SELECT 1 FROM {table} WHERE {column} = $1)", value)
+            if not exists:
+                log_with_user_info("INFO", message, user_info)
         except Exception as e:
-            logger.error(f"❌ Failed to save group {group_id} to database: {e}")
+            logger.error(f"❌ Failed to confirm {column} {value}: {e}")
 
-    # Schedule the save operation without waiting
-    asyncio.create_task(save_group())
+    asyncio.create_task(confirm())
 
-async def get_users_from_database():
+async def get_users_from_database() -> IdSet:
     """Get all user IDs from database"""
     if not db_pool:
-        return list(user_ids)  # Fallback to memory
+        return user_ids  # Fallback to memory
 
     try:
         async with db_pool.acquire() as conn:
             rows = await conn.fetch("SELECT user_id FROM users")
-            return [row['user_id'] for row in rows]
+            return IdSet(row['user_id'] for row in rows)
     except Exception as e:
         logger.error(f"❌ Failed to get users from database: {e}")
-        return list(user_ids)  # Fallback to memory
+        return user_ids  # Fallback to memory
 
-async def get_groups_from_database():
+async def get_groups_from_database() -> IdSet:
     """Get all group IDs from database"""
     if not db_pool:
-        return list(group_ids)  # Fallback to memory
+        return group_ids  # Fallback to memory
 
     try:
         async with db_pool.acquire() as conn:
             rows = await conn.fetch("SELECT group_id FROM groups")
-            return [row['group_id'] for row in rows]
+            return IdSet(row['group_id'] for row in rows)
     except Exception as e:
         logger.error(f"❌ Failed to get groups from database: {e}")
-        return list(group_ids)  # Fallback to memory
+        return group_ids  # Fallback to memory
+
+async def iter_broadcast_targets(target_type: str, after: int = None, page_size: int = ID_CHUNK_SIZE):
+    """Yield user or group IDs in key order one keyset page at a time, resuming after the `after` ID"""
+    table, column, memory_ids = ("users", "user_id", user_ids) if target_type == "users" else ("groups", "group_id", group_ids)
+
+    if not db_pool:
+        # Fallback to memory, merged so it is in key order too
+        memory_ids.merge()
+        for target_id in memory_ids.iter_chunked(page_size):
+            if after is None or target_id > after:
+                yield target_id
+        return
+
+    cursor = after if after is not None else -2**63
+    while True:
+        # One short-lived connection per page, none held while messages are sent
+        async with db_pool.acquire() as conn:
+            rows = await conn.fetch(
+                f"SELECT {column} FROM {table} WHERE {column} > $1 ORDER BY {column} LIMIT $2",
+                cursor, page_size
+            )
+
+        for row in rows:
+            yield row[column]
+
+        if len(rows) < page_size:
+            return
+        cursor = rows[-1][column]
 
 def save_purchase_to_database_async(user_id: int, username: str = None, first_name: str = None, last_name: str = None, amount: int = 0, charge_id: str = None):
     """Save purchase to database asynchronously (fire and forget)"""
@@ -1251,12 +3102,50 @@ def save_purchase_to_database_async(user_id: int, username: str = None, first_na
     async def save_purchase():
         try:
             async with db_pool.acquire() as conn:
-                await conn.execute("""
-                    INSERT INTO purchases (user_id, username, first_name, last_name, amount, telegram_payment_charge_id)
-                    VALUES ($1, $2, $3, $4, $5, $6)
-                    ON CONFLICT (telegram_payment_charge_id) DO NOTHING
-                """, user_id, username, first_name, last_name, amount, charge_id)
-
+                async with conn.transaction():
+                    purchase_id = await conn.fetchval("""
+                        INSERT INTO purchases (user_id, username, first_name, last_name, amount, telegram_payment_charge_id)
+                        VALUES ($1, $2, $3, $4, $5, $6)
+                        ON CONFLICT (telegram_payment_charge_id) DO NOTHING
+                        RETURNING id
+                    """, user_id, username, first_name, last_name, amount, charge_id)
+
+                    # Duplicate charge ids were already counted
+                    if purchase_id is None:
+                        return
+
+                    await conn.execute("""
+                        INSERT INTO buyer_totals (user_id, username, first_name, last_name, total_amount, purchase_count, updated_at)
+                        VALUES ($1, $2, $3, $4, $5, 1, CURRENT_TIMESTAMP)
+                        ON CONFLICT (user_id)
+                        DO UPDATE SET
+                            username = EXCLUDED.username,
+                            first_name = EXCLUDED.first_name,
+                            last_name = EXCLUDED.last_name,
+                            total_amount = buyer_totals.total_amount + EXCLUDED.total_amount,
+                            purchase_count = buyer_totals.purchase_count + 1,
+                            updated_at = CURRENT_TIMESTAMP
+                    """, user_id, username, first_name, last_name, amount)
+
+                    await conn.execute("""
+                        INSERT INTO purchase_totals (id, total_purchases, total_revenue)
+                        VALUES (TRUE, 1, $1)
+                        ON CONFLICT (id)
+                        DO UPDATE SET
+                            total_purchases = purchase_totals.total_purchases + 1,
+                            total_revenue = purchase_totals.total_revenue + EXCLUDED.total_revenue
+                    """, amount)
+
+                    await conn.execute("""
+                        INSERT INTO purchase_hourly (hour, purchases, revenue)
+                        VALUES (date_trunc('hour', CURRENT_TIMESTAMP), 1, $1)
+                        ON CONFLICT (hour)
+                        DO UPDATE SET
+                            purchases = purchase_hourly.purchases + 1,
+                            revenue = purchase_hourly.revenue + EXCLUDED.revenue
+                    """, amount)
+
+            await invalidate_buyers_leaderboard()
             logger.debug(f"💾 Purchase saved to database: user {user_id}, amount {amount}")
 
         except Exception as e:
@@ -1265,23 +3154,122 @@ def save_purchase_to_database_async(user_id: int, username: str = None, first_na
     # Schedule the save operation without waiting
     asyncio.create_task(save_purchase())
 
-async def get_all_purchases():
-    """Get all purchases from database ordered by amount descending"""
+async def get_buyers_page(after: tuple = None, before: tuple = None, limit: int = BUYERS_PAGE_SIZE):
+    """Get one leaderboard page by keyset cursor, plus whether more buyers lie beyond it
+
+    Cursors are (total_amount, user_id) of the row next to the page: `after` walks
+    down the leaderboard, `before` walks back up it.
+    """
     if not db_pool:
-        return []
+        return [], False
 
     try:
         async with db_pool.acquire() as conn:
-            rows = await conn.fetch("""
-                SELECT user_id, username, first_name, last_name, SUM(amount) as total_amount, COUNT(*) as purchase_count
-                FROM purchases
-                GROUP BY user_id, username, first_name, last_name
-                ORDER BY total_amount DESC
-            """)
-            return rows
+            if after:
+                rows = await conn.fetch("""
+                    SELECT user_id, username, first_name, last_name, total_amount, purchase_count
+                    FROM buyer_totals
+                    WHERE total_amount < $1 OR (total_amount = $1 AND user_id > $2)
+                    ORDER BY total_amount DESC, user_id
+                    LIMIT $3
+                """, after[0], after[1], limit + 1)
+            elif before:
+                rows = await conn.fetch("""
+                    SELECT user_id, username, first_name, last_name, total_amount, purchase_count
+                    FROM buyer_totals
+                    WHERE total_amount > $1 OR (total_amount = $1 AND user_id < $2)
+                    ORDER BY total_amount, user_id DESC
+                    LIMIT $3
+                """, before[0], before[1], limit + 1)
+            else:
+                rows = await conn.fetch("""
+                    SELECT user_id, username, first_name, last_name, total_amount, purchase_count
+                    FROM buyer_totals
+                    ORDER BY total_amount DESC, user_id
+                    LIMIT $1
+                """, limit + 1)
+
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if before:
+            rows.reverse()
+        return rows, has_more
     except Exception as e:
-        logger.error(f"❌ Failed to get purchases from database: {e}")
-        return []
+        logger.error(f"❌ Failed to get buyers from database: {e}")
+        return [], False
+
+async def get_buyers_total() -> int:
+    """Get the number of buyers, cached in Valkey until the next purchase"""
+    cached = await cache_get("buyers_total")
+    if cached is not None:
+        return cached
+
+    if not db_pool:
+        return 0
+
+    try:
+        async with db_pool.acquire() as conn:
+            total_buyers = await conn.fetchval("SELECT COUNT(*) FROM buyer_totals")
+        await cache_set("buyers_total", total_buyers, BUYERS_CACHE_TTL)
+        return total_buyers
+    except Exception as e:
+        logger.error(f"❌ Failed to count buyers: {e}")
+        return 0
+
+async def get_buyers_leaderboard(page: int = 0, direction: str = None, cursor: tuple = None) -> dict:
+    """Get a rendered /buyers page with its navigation cursors
+
+    The first BUYERS_CACHED_PAGES pages are cached in Valkey by page index until the next purchase.
+    Cursors come from callback data, so a page index is only served from or written to
+    the cache when the cursor matches the edge of the cached neighbouring page - a
+    stale button or a forged cursor gets its page rendered but never cached.
+    """
+    if page <= 0 or not cursor or direction not in ("n", "p"):
+        page, direction, cursor = 0, None, None
+
+    cacheable = page < BUYERS_CACHED_PAGES
+    if cacheable and page:
+        neighbour = await cache_get(f"buyers_page:{page - 1 if direction == 'n' else page + 1}")
+        edge = "last" if direction == "n" else "first"
+        cacheable = bool(neighbour) and neighbour.get(edge) == list(cursor)
+
+    if cacheable:
+        cached = await cache_get(f"buyers_page:{page}")
+        if cached:
+            return cached
+
+    if direction == "n":
+        buyers, has_next = await get_buyers_page(after=cursor)
+        has_prev = True
+    elif direction == "p":
+        buyers, has_prev = await get_buyers_page(before=cursor)
+        has_next = True
+    else:
+        buyers, has_next = await get_buyers_page()
+        has_prev = False
+
+    # The leaderboard moved under a stale button, start over from the top
+    if page and (not buyers or not has_prev):
+        return await get_buyers_leaderboard()
+
+    total_buyers = await get_buyers_total()
+    leaderboard = {
+        "page": page,
+        "text": render_buyers_leaderboard(buyers, total_buyers, page),
+        "first": [buyers[0]['total_amount'], buyers[0]['user_id']] if buyers else None,
+        "last": [buyers[-1]['total_amount'], buyers[-1]['user_id']] if buyers else None,
+        "has_prev": has_prev,
+        "has_next": has_next
+    }
+
+    # Only cache what came from the database, not an outage
+    if db_pool and cacheable:
+        await cache_set(f"buyers_page:{page}", leaderboard, BUYERS_CACHE_TTL)
+    return leaderboard
+
+async def invalidate_buyers_leaderboard():
+    """Drop the cached buyers pages and count after a purchase"""
+    await cache_delete("buyers_total", *(f"buyers_page:{page}" for page in range(BUYERS_CACHED_PAGES)))
 
 async def close_database():
     """Close database connection pool"""
@@ -1294,9 +3282,7 @@ async def close_database():
 
 async def remove_user_from_database(user_id: int):
     """Remove a user from the database and memory."""
-    global user_ids
-    if user_id in user_ids:
-        user_ids.remove(user_id)
+    user_ids.remove(user_id)
 
     if not db_pool:
         logger.warning(f"⚠️ DB pool not available. Cannot remove user {user_id}.")
@@ -1310,22 +3296,318 @@ async def remove_user_from_database(user_id: int):
         logger.error(f"❌ Failed to remove user {user_id} from database: {e}")
 
 
-async def remove_group_from_database(group_id: int):
-    """Remove a group from the database and memory."""
-    global group_ids
-    if group_id in group_ids:
-        group_ids.remove(group_id)
+async def remove_group_from_database(group_id: int):
+    """Remove a group from the database and memory."""
+    group_ids.remove(group_id)
+
+    if not db_pool:
+        logger.warning(f"⚠️ DB pool not available. Cannot remove group {group_id}.")
+        return
+
+    try:
+        async with db_pool.acquire() as conn:
+            await conn.execute("DELETE FROM groups WHERE group_id = $1", group_id)
+        logger.info(f"✅ Group {group_id} removed from database.")
+    except Exception as e:
+        logger.error(f"❌ Failed to remove group {group_id} from database: {e}")
+
+
+# SYSTEM METRICS SAMPLER
+class MetricsSampler:
+    """Samples process and system metrics in the background into fixed-size ring buffers"""
+
+    METRICS = ("cpu", "memory", "rss", "loop_lag", "fds", "tasks")
+
+    def __init__(self, interval: float, size: int):
+        self.interval = interval
+        self.size = size
+        self.values = {name: array('d', [0.0] * size) for name in self.METRICS}
+        self.index = 0
+        self.count = 0
+        self.process = psutil.Process()
+        self.started_at = self.process.create_time()
+        self.memory_total = psutil.virtual_memory().total
+        self.task = None
+
+    def sample(self, loop_lag: float):
+        """Record one sample of every metric"""
+        try:
+            fds = self.process.num_fds()
+        except (AttributeError, psutil.Error):
+            # Not available on Windows
+            fds = 0
+
+        sample = {
+            "cpu": psutil.cpu_percent(interval=None),
+            "memory": psutil.virtual_memory().percent,
+            "rss": self.process.memory_info().rss,
+            "loop_lag": loop_lag * 1000,
+            "fds": fds,
+            "tasks": len(asyncio.all_tasks())
+        }
+        for name, value in sample.items():
+            self.values[name][self.index] = value
+        self.index = (self.index + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def summary(self, name: str) -> Optional[tuple]:
+        """Get (min, avg, max) of a metric over the buffered samples"""
+        if not self.count:
+            return None
+        values = self.values[name][:self.count] if self.count < self.size else self.values[name]
+        return min(values), sum(values) / len(values), max(values)
+
+    async def run(self):
+        """Sample every interval, measuring event loop lag from the sleep overshoot"""
+        # The first non-blocking cpu_percent call only sets the baseline
+        psutil.cpu_percent(interval=None)
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            try:
+                self.sample(max(time.monotonic() - started - self.interval, 0.0))
+            except Exception as e:
+                logger.error(f"❌ Error sampling system metrics: {e}")
+
+    def start(self):
+        """Start the background sampling loop"""
+        if not self.task:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """Stop the sampling loop"""
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+metrics_sampler = MetricsSampler(METRICS_SAMPLE_INTERVAL, METRICS_SAMPLES)
+
+def format_metric(name: str, fmt=lambda value: f"{value:.1f}") -> str:
+    """Format a sampled metric as min/avg/max for /stats"""
+    summary = metrics_sampler.summary(name)
+    if summary is None:
+        return "<b>N/A</b>"
+    low, avg, high = summary
+    return f"<b>{fmt(avg)}</b> ({fmt(low)} / {fmt(high)})"
+
+
+# STATS HISTORY
+# One slot per minute for the last STATS_HISTORY_MINUTES minutes, in fixed array('d')
+# rings. minutes[] holds the minute each slot was written for, so slots left over
+# from before a gap read as empty. Counters are per-minute totals; latency gauges
+# are milliseconds and NaN for minutes without observations.
+HISTORY_COUNTERS = ("messages", "gemini_calls", "rate_limited", "errors")
+HISTORY_GAUGES = ("gemini_p50", "gemini_p99", "valkey_rtt", "db_wait")
+HISTORY_LABELS = {
+    "messages": "Messages",
+    "gemini_calls": "Gemini",
+    "gemini_p50": "Gemini p50",
+    "gemini_p99": "Gemini p99",
+    "valkey_rtt": "Valkey RTT",
+    "db_wait": "DB Wait",
+    "rate_limited": "Limited",
+    "errors": "Errors"
+}
+SPARKLINE_BLOCKS = "▁▂▃▄▅▆▇█"
+
+class StatsHistory:
+    """Per-minute load history in fixed-size ring buffers, persisted to Valkey"""
+
+    def __init__(self, size: int):
+        self.size = size
+        self.minutes = array('q', [-1] * size)
+        self.values = {name: array('d', [0.0] * size) for name in HISTORY_COUNTERS + HISTORY_GAUGES}
+        self.minute = int(time.time() // 60)
+        self.reset()
+        self.task = None
+
+    def reset(self):
+        """Clear the accumulators of the minute in progress"""
+        self.counts = dict.fromkeys(HISTORY_COUNTERS, 0)
+        self.gemini_latencies = []
+        self.latency_totals = {"valkey_rtt": [0.0, 0], "db_wait": [0.0, 0]}
+
+    def roll(self, now: float = None):
+        """Commit the minute in progress once the clock has moved past it"""
+        minute = int((time.time() if now is None else now) // 60)
+        if minute <= self.minute:
+            return
+
+        slot = self.minute % self.size
+        self.minutes[slot] = self.minute
+        for name, value in self.counts.items():
+            self.values[name][slot] = value
+
+        latencies = self.gemini_latencies
+        if latencies:
+            latencies.sort()
+            self.values["gemini_p50"][slot] = latencies[len(latencies) // 2]
+            self.values["gemini_p99"][slot] = latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)]
+        else:
+            self.values["gemini_p50"][slot] = self.values["gemini_p99"][slot] = math.nan
+
+        for name, (total, count) in self.latency_totals.items():
+            self.values[name][slot] = total / count if count else math.nan
+
+        self.minute = minute
+        self.reset()
+
+    def count(self, name: str, amount: int = 1):
+        """Add to a counter for the current minute"""
+        self.roll()
+        self.counts[name] += amount
+
+    def observe(self, name: str, seconds: float):
+        """Record a latency (gemini, valkey_rtt or db_wait) for the current minute"""
+        self.roll()
+        if name == "gemini":
+            self.gemini_latencies.append(seconds * 1000)
+        else:
+            totals = self.latency_totals[name]
+            totals[0] += seconds * 1000
+            totals[1] += 1
+
+    def series(self, name: str, minutes: int, width: int) -> list:
+        """Get a metric over the last complete minutes as exactly width points
+
+        Buckets are minutes // width minutes wide, so every range renders at the same
+        width (STATS_RANGES divide evenly into STATS_SPARKLINE_WIDTH points).
+        Counters are summed per bucket, gauges keep the bucket's peak.
+        """
+        self.roll()
+        is_counter = name in HISTORY_COUNTERS
+        values = self.values[name]
+        bucket_size = max(1, minutes // width)
+        start = self.minute - bucket_size * width
+
+        points = []
+        for bucket_start in range(start, self.minute, bucket_size):
+            bucket = []
+            for minute in range(bucket_start, min(bucket_start + bucket_size, self.minute)):
+                slot = minute % self.size
+                if self.minutes[slot] == minute and not math.isnan(values[slot]):
+                    bucket.append(values[slot])
+            if is_counter:
+                points.append(sum(bucket))
+            else:
+                points.append(max(bucket) if bucket else math.nan)
+        return points
+
+    async def persist(self):
+        """Save the rings to Valkey so history survives restarts"""
+        if not valkey_ready():
+            return
+
+        mapping = {"minutes": zstd_compressor.compress(self.minutes.tobytes())}
+        for name, values in self.values.items():
+            mapping[name] = zstd_compressor.compress(values.tobytes())
+        try:
+            await valkey_raw.hset("stats_history", mapping=mapping)
+        except Exception as e:
+            logger.error(f"❌ Failed to persist stats history: {e}", extra={"stats_history": True})
+
+    async def restore(self):
+        """Load rings saved by a previous run"""
+        if not valkey_ready():
+            return
+
+        try:
+            saved = await valkey_raw.hgetall("stats_history")
+            if not saved:
+                return
+
+            minutes = array('q')
+            minutes.frombytes(zstd_decompressor.decompress(saved[b"minutes"]))
+            values = {}
+            for name in self.values:
+                values[name] = array('d')
+                values[name].frombytes(zstd_decompressor.decompress(saved[name.encode()]))
+            if len(minutes) != self.size or any(len(ring) != self.size for ring in values.values()):
+                logger.warning("⚠️ Saved stats history has a different size, starting fresh")
+                return
 
-    if not db_pool:
-        logger.warning(f"⚠️ DB pool not available. Cannot remove group {group_id}.")
-        return
+            # Keep whatever this run already committed
+            for slot in range(self.size):
+                if minutes[slot] > self.minutes[slot]:
+                    self.minutes[slot] = minutes[slot]
+                    for name, ring in values.items():
+                        self.values[name][slot] = ring[slot]
+            logger.info("📈 Stats history restored from Valkey")
+        except Exception as e:
+            logger.error(f"❌ Failed to restore stats history: {e}", extra={"stats_history": True})
 
-    try:
-        async with db_pool.acquire() as conn:
-            await conn.execute("DELETE FROM groups WHERE group_id = $1", group_id)
-        logger.info(f"✅ Group {group_id} removed from database.")
-    except Exception as e:
-        logger.error(f"❌ Failed to remove group {group_id} from database: {e}")
+    async def run(self):
+        """Commit each minute, probe DB pool wait and persist every few minutes"""
+        while True:
+            await asyncio.sleep(60 - time.time() % 60)
+            try:
+                if db_pool:
+                    started = time.monotonic()
+                    async with db_pool.acquire():
+                        pass
+                    self.observe("db_wait", time.monotonic() - started)
+
+                self.roll()
+                if self.minute % STATS_PERSIST_MINUTES == 0:
+                    await self.persist()
+            except Exception as e:
+                logger.error(f"❌ Error updating stats history: {e}", extra={"stats_history": True})
+
+    async def start(self):
+        """Restore saved history and start the per-minute loop"""
+        await self.restore()
+        if not self.task:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """Stop the per-minute loop and persist"""
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await self.persist()
+
+stats_history = StatsHistory(STATS_HISTORY_MINUTES)
+
+class ErrorCountHandler(logging.Handler):
+    """Counts ERROR log records into the stats history, except the history's own"""
+
+    def emit(self, record):
+        if not getattr(record, "stats_history", False):
+            stats_history.count("errors")
+
+def render_sparkline(points: list) -> str:
+    """Render points as unicode block characters scaled to their peak"""
+    peak = max((point for point in points if not math.isnan(point)), default=0)
+    line = ""
+    for point in points:
+        if math.isnan(point):
+            line += " "
+        elif peak <= 0:
+            line += SPARKLINE_BLOCKS[0]
+        else:
+            line += SPARKLINE_BLOCKS[round(point / peak * (len(SPARKLINE_BLOCKS) - 1))]
+    return line
+
+def render_stats_history(hours: int) -> str:
+    """Render the /stats trends block for the last hours"""
+    lines = []
+    for name in HISTORY_COUNTERS[:2] + HISTORY_GAUGES + HISTORY_COUNTERS[2:]:
+        points = stats_history.series(name, hours * 60, STATS_SPARKLINE_WIDTH)
+        if name in HISTORY_COUNTERS:
+            summary = f"{sum(points):.0f}"
+        else:
+            observed = [point for point in points if not math.isnan(point)]
+            summary = f"{max(observed):.0f}ms" if observed else "-"
+        lines.append(f"{HISTORY_LABELS[name]:<10} {render_sparkline(points)} {summary}")
+    return "\n".join(lines)
 
 
 # UTILITY FUNCTIONS
@@ -1410,16 +3692,21 @@ def validate_config() -> bool:
 
 async def update_user_response_time_valkey(user_id: int) -> None:
     """Update the last response time for user in Valkey"""
-    if valkey_client:
+    state = current_update_state.get()
+    if valkey_ready() and state and state.user_id == user_id:
+        # Buffered until the end of the update
+        now = int(time.time())
+        state.queue(lambda pipe: (pipe.hset(user_key(user_id), "last_response", now), touch_user_keys(pipe, user_id)))
+    elif valkey_ready():
         try:
-            key = f"last_response:{user_id}"
-            await valkey_client.setex(key, SESSION_TTL, int(time.time()))
+            await set_user_fields(user_id, {"last_response": int(time.time())})
             logger.debug(f"⏰ Updated response time in Valkey for user {user_id}")
         except Exception as e:
             logger.error(f"❌ Failed to update response time in Valkey for user {user_id}: {e}")
 
     # Also update memory as fallback
     user_last_response_time[user_id] = time.time()
+    schedule_conversation_expiry(user_id, user_last_response_time[user_id])
 
 
 def should_respond_in_group(update: Update, bot_id: int) -> bool:
@@ -1445,9 +3732,10 @@ def track_user_and_chat(update: Update, user_info: Dict[str, any]) -> None:
     chat_type = user_info["chat_type"]
 
     if chat_type == "private":
-        is_new_user = user_id not in user_ids
+        record_active_user(user_id)
+        known_user = is_known_id(user_id, user_ids)
         # Add to memory immediately (fast)
-        user_ids.add(user_id)
+        remember_id(user_id, user_ids)
 
         # Save to database asynchronously (non-blocking) to add or update user info
         save_user_to_database_async(
@@ -1456,13 +3744,15 @@ def track_user_and_chat(update: Update, user_info: Dict[str, any]) -> None:
             user_info.get("first_name"),
             user_info.get("last_name")
         )
-        if is_new_user:
+        if known_user is None:
+            confirm_new_id_async(user_id, "users", "user_id", "👤 New user tracked for broadcasting", user_info)
+        elif not known_user:
             log_with_user_info("INFO", f"👤 New user tracked for broadcasting", user_info)
 
     elif chat_type in ['group', 'supergroup']:
-        is_new_group = chat_id not in group_ids
+        known_group = is_known_id(chat_id, group_ids)
         # Add to memory immediately (fast)
-        group_ids.add(chat_id)
+        remember_id(chat_id, group_ids)
 
         # Save to database asynchronously (non-blocking) to add or update group info
         save_group_to_database_async(
@@ -1471,7 +3761,9 @@ def track_user_and_chat(update: Update, user_info: Dict[str, any]) -> None:
             user_info.get("username"),
             chat_type
         )
-        if is_new_group:
+        if known_group is None:
+            confirm_new_id_async(chat_id, "groups", "group_id", "📢 New group tracked for broadcasting", user_info)
+        elif not known_group:
             log_with_user_info("INFO", f"📢 New group tracked for broadcasting", user_info)
 
 
@@ -1482,31 +3774,43 @@ def get_user_mention(user) -> str:
 
 
 # CONVERSATION MEMORY FUNCTIONS
-async def add_to_conversation_history(user_id: int, message: str, is_user: bool = True):
-    """Add message to user's conversation history (Valkey + memory fallback)"""
+async def append_conversation_messages(user_id: int, messages: list):
+    """Append messages to user's conversation history (Valkey list + memory fallback)"""
     global conversation_history
 
-    role = "user" if is_user else "assistant"
-    new_message = {"role": role, "content": message}
+    # Buffer the write when handling an update with prefetched history
+    state = current_update_state.get()
+    if valkey_ready() and state and state.user_id == user_id and state.history is not None:
+        key = user_history_key(user_id)
+        encoded = [encode_history_message(message) for message in messages]
+
+        def write(pipe):
+            pipe.rpush(key, *encoded)
+            pipe.ltrim(key, -CHAT_LENGTH, -1)
+            touch_user_keys(pipe, user_id)
+            queue_invalidation(pipe, f"history:{user_id}")
+
+        state.queue(write)
+        state.history = (state.history + messages)[-CHAT_LENGTH:]
+        state.pending_history.extend(messages)
+        l1_cache.set(f"history:{user_id}", state.history, SESSION_TTL)
+        return
 
-    # Try Valkey first
-    if valkey_client:
+    # Try Valkey first - push, trim and refresh TTL in one round trip
+    if valkey_ready():
         try:
-            key = f"conversation:{user_id}"
-            existing = await valkey_client.get(key)
-
-            if existing:
-                history = json.loads(existing)
-            else:
-                history = []
-
-            history.append(new_message)
-
-            # Keep only last CHAT_LENGTH messages
-            if len(history) > CHAT_LENGTH:
-                history = history[-CHAT_LENGTH:]
-
-            await valkey_client.setex(key, SESSION_TTL, json.dumps(history))
+            key = user_history_key(user_id)
+            pipe = valkey_raw.pipeline(transaction=True)
+            pipe.rpush(key, *[encode_history_message(message) for message in messages])
+            pipe.ltrim(key, -CHAT_LENGTH, -1)
+            touch_user_keys(pipe, user_id)
+            queue_invalidation(pipe, f"history:{user_id}")
+            await pipe.execute()
+
+            # Write through to L1 if this process already holds the history
+            cached_history = l1_cache.get(f"history:{user_id}")
+            if cached_history is not None:
+                l1_cache.set(f"history:{user_id}", (cached_history + messages)[-CHAT_LENGTH:], SESSION_TTL)
             logger.debug(f"💬 Conversation updated in Valkey for user {user_id}")
             return
 
@@ -1516,24 +3820,39 @@ async def add_to_conversation_history(user_id: int, message: str, is_user: bool
     # Fallback to memory
     if user_id not in conversation_history:
         conversation_history[user_id] = []
+        schedule_conversation_expiry(user_id, user_last_response_time.get(user_id, time.time()))
 
-    conversation_history[user_id].append(new_message)
+    conversation_history[user_id].extend(messages)
 
     # Keep only last CHAT_LENGTH messages
     if len(conversation_history[user_id]) > CHAT_LENGTH:
         conversation_history[user_id] = conversation_history[user_id][-CHAT_LENGTH:]
 
+async def add_conversation_turn(user_id: int, user_message: str, ai_response: str):
+    """Add user message and Sakura's reply to conversation history in one call"""
+    await append_conversation_messages(user_id, [
+        {"role": "user", "content": user_message},
+        {"role": "assistant", "content": ai_response}
+    ])
+
 async def get_conversation_context(user_id: int) -> str:
     """Get formatted conversation context for the user (Valkey + memory fallback)"""
     history = []
 
+    # Use history prefetched for this update if there is one
+    state = current_update_state.get()
+    if state and state.user_id == user_id and state.history is not None:
+        history = state.history
+
     # Try Valkey first
-    if valkey_client:
+    elif valkey_ready():
+        history = l1_cache.get(f"history:{user_id}")
         try:
-            key = f"conversation:{user_id}"
-            existing = await valkey_client.get(key)
-            if existing:
-                history = json.loads(existing)
+            if history is None:
+                existing = await valkey_raw.lrange(user_history_key(user_id), 0, -1)
+                history = [decode_history_message(item) for item in existing]
+                if history:
+                    l1_cache.set(f"history:{user_id}", history, SESSION_TTL)
         except Exception as e:
             logger.error(f"❌ Failed to get conversation from Valkey for user {user_id}: {e}")
 
@@ -1554,31 +3873,45 @@ async def get_conversation_context(user_id: int) -> str:
     return "\n".join(context_lines)
 
 
-async def cleanup_old_conversations():
-    """Clean up old conversation histories and response times periodically"""
-    global conversation_history, user_last_response_time
+def schedule_conversation_expiry(user_id: int, last_activity: float):
+    """Queue a user's memory conversation for expiry OLD_CHAT after their last activity"""
+    global conversation_expiry
+
+    heapq.heappush(conversation_expiry, (last_activity + OLD_CHAT, user_id))
+
+    # Superseded entries are skipped lazily; rebuild once they outnumber live users
+    live_users = len(user_last_response_time) + len(conversation_history)
+    if len(conversation_expiry) > 2 * live_users + 1024:
+        conversation_expiry = [
+            (user_last_response_time.get(uid, last_activity) + OLD_CHAT, uid)
+            for uid in set(user_last_response_time) | set(conversation_history)
+        ]
+        heapq.heapify(conversation_expiry)
+
+def expire_conversations(current_time: float) -> int:
+    """Evict memory conversations and response times whose deadline has passed"""
+    conversations_cleaned = 0
+
+    while conversation_expiry and conversation_expiry[0][0] <= current_time:
+        _, user_id = heapq.heappop(conversation_expiry)
+
+        # A later activity queued a newer deadline for this user
+        if user_last_response_time.get(user_id, 0) + OLD_CHAT > current_time:
+            continue
+
+        if conversation_history.pop(user_id, None) is not None:
+            conversations_cleaned += 1
+        user_last_response_time.pop(user_id, None)
 
+    return conversations_cleaned
+
+async def cleanup_old_conversations():
+    """Expire old conversation histories and response times close to their deadline"""
     logger.info("🧹 Conversation cleanup task started")
 
     while True:
         try:
-            current_time = time.time()
-            conversations_cleaned = 0
-
-            # Find expired conversations
-            expired_users = []
-            for user_id in list(conversation_history.keys()):
-                last_response_time = user_last_response_time.get(user_id, 0)
-                if current_time - last_response_time > OLD_CHAT:
-                    expired_users.append(user_id)
-
-            # Remove expired conversations
-            for user_id in expired_users:
-                if user_id in conversation_history:
-                    del conversation_history[user_id]
-                    conversations_cleaned += 1
-                if user_id in user_last_response_time:
-                    del user_last_response_time[user_id]
+            conversations_cleaned = expire_conversations(time.time())
 
             # Log cleanup results
             if conversations_cleaned > 0:
@@ -1593,15 +3926,25 @@ async def cleanup_old_conversations():
         except Exception as e:
             logger.error(f"❌ Error in conversation cleanup: {e}")
 
-        # Wait for next cleanup cycle (with cancellation support)
+        # Sleep until the next deadline; new entries never expire before the current earliest one
+        next_deadline = conversation_expiry[0][0] if conversation_expiry else time.time() + CHAT_CLEANUP
         try:
-            await asyncio.sleep(CHAT_CLEANUP)
+            await asyncio.sleep(min(max(next_deadline - time.time(), 1), CHAT_CLEANUP))
         except asyncio.CancelledError:
             logger.info("🧹 Cleanup task sleep cancelled - shutting down")
             break
 
 
 # AI RESPONSE FUNCTIONS
+async def generate_gemini_content(**kwargs):
+    """Call Gemini generate_content, recording the call and its latency"""
+    stats_history.count("gemini_calls")
+    start = time.monotonic()
+    try:
+        return await gemini_client.aio.models.generate_content(**kwargs)
+    finally:
+        stats_history.observe("gemini", time.monotonic() - start)
+
 async def get_gemini_response(user_message: str, user_name: str = "", user_info: Dict[str, any] = None, user_id: int = None) -> str:
     """Get response from Gemini API with conversation context and caching"""
     if user_info:
@@ -1625,16 +3968,16 @@ async def get_gemini_response(user_message: str, user_name: str = "", user_info:
 
         # Check cache for similar short messages (without personal context)
         cache_key = None
-        if len(user_message) <= 50 and not context and user_id:  # Only cache short, context-free messages
-            import hashlib
-            cache_key = f"gemini_response:{user_id}:{hashlib.md5(user_message.lower().encode()).hexdigest()}"
-            cached_response = await cache_get(cache_key)
+        if not context:  # Only cache short, context-free messages
+            cache_key = get_response_cache_key(user_id, user_message)
+        if cache_key:
+            cached_response = await get_cached_response(user_id, cache_key)
             if cached_response:
                 if user_info:
                     log_with_user_info("INFO", f"📦 Using cached response for message", user_info)
                 return cached_response
 
-        response = await gemini_client.aio.models.generate_content(
+        response = await generate_gemini_content(
             model="gemini-2.5-flash",
             contents=prompt
         )
@@ -1643,12 +3986,11 @@ async def get_gemini_response(user_message: str, user_name: str = "", user_info:
 
         # Cache the response if it was a short, context-free message
         if cache_key:
-            await cache_set(cache_key, ai_response, CACHE_TTL)
+            await cache_response(user_id, cache_key, ai_response)
 
         # Add messages to conversation history
         if user_id:
-            await add_to_conversation_history(user_id, user_message, is_user=True)
-            await add_to_conversation_history(user_id, ai_response, is_user=False)
+            await add_conversation_turn(user_id, user_message, ai_response)
 
         if user_info:
             log_with_user_info("INFO", f"✅ Gemini response generated: '{ai_response[:50]}...'", user_info)
@@ -1698,7 +4040,7 @@ Sakura's response:"""
         # Convert bytes to base64 string
         image_data = base64.b64encode(image_bytes).decode('utf-8')
 
-        response = await gemini_client.aio.models.generate_content(
+        response = await generate_gemini_content(
             model="gemini-2.5-flash",
             contents=[
                 image_prompt,
@@ -1716,8 +4058,7 @@ Sakura's response:"""
         # Add messages to conversation history
         if user_id:
             image_description = f"[Image: {caption}]" if caption else "[Image sent]"
-            await add_to_conversation_history(user_id, image_description, is_user=True)
-            await add_to_conversation_history(user_id, ai_response, is_user=False)
+            await add_conversation_turn(user_id, image_description, ai_response)
 
         if user_info:
             log_with_user_info("INFO", f"✅ Image analysis completed: '{ai_response[:50]}...'", user_info)
@@ -1893,7 +4234,7 @@ Analyze this poll question and respond in Sakura's style about which option you
 
 Sakura's response:"""
 
-        response = await gemini_client.aio.models.generate_content(
+        response = await generate_gemini_content(
             model="gemini-2.5-flash",
             contents=poll_prompt
         )
@@ -1903,8 +4244,7 @@ Sakura's response:"""
         # Add messages to conversation history
         if user_id:
             poll_description = f"[Poll: {poll_question}] Options: {', '.join(poll_options)}"
-            await add_to_conversation_history(user_id, poll_description, is_user=True)
-            await add_to_conversation_history(user_id, ai_response, is_user=False)
+            await add_conversation_turn(user_id, poll_description, ai_response)
 
         if user_info:
             log_with_user_info("INFO", f"✅ Poll analysis completed: '{ai_response[:50]}...'", user_info)
@@ -1938,6 +4278,45 @@ async def send_sticker_action(context: ContextTypes.DEFAULT_TYPE, chat_id: int,
     await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.CHOOSE_STICKER)
 
 
+# COMMAND PIPELINE FUNCTIONS
+async def send_command_reaction(context: ContextTypes.DEFAULT_TYPE, update: Update, user_info: Dict[str, any]) -> None:
+    """React to a command message with a random emoji (animated in private chat)"""
+    if not EMOJI_REACT:
+        return
+
+    random_emoji = random.choice(EMOJI_REACT)
+
+    # Use Telethon for animated emoji reactions
+    if effects_client and update.effective_chat.type == "private":
+        reaction_sent = await send_animated_reaction(
+            update.effective_chat.id,
+            update.message.message_id,
+            random_emoji
+        )
+        if reaction_sent:
+            log_with_user_info("DEBUG", f"🎭 Added animated emoji reaction: {random_emoji}", user_info)
+            return
+
+    # Group chat, no Telethon or animated reaction failed - use PTB reaction
+    await add_ptb_reaction(context, update, random_emoji, user_info)
+
+
+async def run_with_cosmetics(main, *cosmetics, user_info: Dict[str, any] = None):
+    """Run the main send chain concurrently with cosmetic steps (reactions, chat actions)
+
+    Cosmetic failures are only logged; errors from the main chain are re-raised.
+    """
+    results = await asyncio.gather(main, *cosmetics, return_exceptions=True)
+
+    for result in results[1:]:
+        if isinstance(result, Exception):
+            log_with_user_info("WARNING", f"⚠️ Cosmetic step failed: {result}", user_info or {})
+
+    if isinstance(results[0], BaseException):
+        raise results[0]
+    return results[0]
+
+
 # KEYBOARD CREATION FUNCTIONS
 def create_initial_start_keyboard() -> InlineKeyboardMarkup:
     """Create initial start keyboard with Info and Hi buttons"""
@@ -1999,11 +4378,11 @@ def create_broadcast_keyboard() -> InlineKeyboardMarkup:
     keyboard = [
         [
             InlineKeyboardButton(
-                BROADCAST_MESSAGES["button_texts"]["users"].format(count=len(user_ids)),
+                BROADCAST_MESSAGES["button_texts"]["users"].format(count=count_users()),
                 callback_data="bc_users"
             ),
             InlineKeyboardButton(
-                BROADCAST_MESSAGES["button_texts"]["groups"].format(count=len(group_ids)),
+                BROADCAST_MESSAGES["button_texts"]["groups"].format(count=count_groups()),
                 callback_data="bc_groups"
             )
         ]
@@ -2014,8 +4393,8 @@ def create_broadcast_keyboard() -> InlineKeyboardMarkup:
 def get_broadcast_text() -> str:
     """Get broadcast command text"""
     return BROADCAST_MESSAGES["select_target"].format(
-        users_count=len(user_ids),
-        groups_count=len(group_ids)
+        users_count=count_users(),
+        groups_count=count_groups()
     )
 
 
@@ -2028,84 +4407,43 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
 
         track_user_and_chat(update, user_info)
 
-        # Step 1: React to the start message with random emoji and animation
-        if EMOJI_REACT:
-            try:
-                random_emoji = random.choice(EMOJI_REACT)
-
-                # Use Telethon for animated emoji reactions
-                if effects_client and update.effective_chat.type == "private":
-                    reaction_sent = await send_animated_reaction(
-                        update.effective_chat.id,
-                        update.message.message_id,
-                        random_emoji
-                    )
-                    if reaction_sent:
-                        log_with_user_info("DEBUG", f"🎭 Added animated emoji reaction: {random_emoji}", user_info)
-                    else:
-                        # Fallback to PTB reaction without animation
-                        await add_ptb_reaction(context, update, random_emoji, user_info)
-                else:
-                    # Group chat or no Telethon - use PTB reaction
-                    await add_ptb_reaction(context, update, random_emoji, user_info)
-
-            except Exception as e:
-                log_with_user_info("WARNING", f"⚠️ Failed to add emoji reaction: {e}", user_info)
-
-        # Step 2: Send random sticker (only in private chat)
-        if update.effective_chat.type == "private" and START_STICKERS:
-            await send_sticker_action(context, update.effective_chat.id, user_info)
+        chat_id = update.effective_chat.id
+        send_sticker = update.effective_chat.type == "private" and START_STICKERS
 
-            random_sticker = random.choice(START_STICKERS)
-            log_with_user_info("DEBUG", f"🎭 Sending start sticker: {random_sticker}", user_info)
-
-            await context.bot.send_sticker(
-                chat_id=update.effective_chat.id,
-                sticker=random_sticker
-            )
-            log_with_user_info("INFO", "✅ Start sticker sent successfully", user_info)
+        async def send_start_messages():
+            # Step 1: Send random sticker first (only in private chat)
+            if send_sticker:
+                random_sticker = random.choice(START_STICKERS)
+                log_with_user_info("DEBUG", f"🎭 Sending start sticker: {random_sticker}", user_info)
 
-        # Step 3: Send the initial welcome message with photo and two-step buttons
-        await send_photo_action(context, update.effective_chat.id, user_info)
+                await context.bot.send_sticker(chat_id=chat_id, sticker=random_sticker)
+                log_with_user_info("INFO", "✅ Start sticker sent successfully", user_info)
 
-        random_image = random.choice(SAKURA_IMAGES)
-        keyboard = create_initial_start_keyboard()
-        user_mention = get_user_mention(update.effective_user)
-        caption = get_initial_start_caption(user_mention)
+            # Step 2: Send the initial welcome message with photo and two-step buttons
+            random_image = random.choice(SAKURA_IMAGES)
+            keyboard = create_initial_start_keyboard()
+            user_mention = get_user_mention(update.effective_user)
+            caption = get_initial_start_caption(user_mention)
 
-        log_with_user_info("DEBUG", f"📷 Sending initial start photo: {random_image[:50]}...", user_info)
+            log_with_user_info("DEBUG", f"📷 Sending initial start photo: {random_image[:50]}...", user_info)
 
-        # Send with effects if in private chat
-        if update.effective_chat.type == "private":
-            # Use Telethon effects for the main start message
-            effect_sent = await send_with_effect_photo(
-                update.effective_chat.id,
-                random_image,
-                caption,
-                keyboard
-            )
-            if effect_sent:
-                log_with_user_info("INFO", "✨ Start command with effects sent successfully", user_info)
-            else:
-                # Fallback to normal PTB message if effects fail
-                await context.bot.send_photo(
-                    chat_id=update.effective_chat.id,
-                    photo=random_image,
-                    caption=caption,
-                    parse_mode=ParseMode.HTML,
-                    reply_markup=keyboard
-                )
-                log_with_user_info("WARNING", "⚠️ Start command sent without effects (fallback)", user_info)
-        else:
-            # Group chat - no effects, just normal message
-            await context.bot.send_photo(
-                chat_id=update.effective_chat.id,
+            # Send with effects where supported (private chats)
+            await send_effect_message(
+                chat_id,
+                update.effective_chat.type,
+                text=caption,
                 photo=random_image,
-                caption=caption,
-                parse_mode=ParseMode.HTML,
                 reply_markup=keyboard
             )
 
+        # Reaction and chat action run alongside the ordered sticker -> photo chain
+        await run_with_cosmetics(
+            send_start_messages(),
+            send_command_reaction(context, update, user_info),
+            send_sticker_action(context, chat_id, user_info) if send_sticker else send_photo_action(context, chat_id, user_info),
+            user_info=user_info
+        )
+
         log_with_user_info("INFO", "✅ Start command completed successfully", user_info)
 
     except Exception as e:
@@ -2122,73 +4460,28 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 
         track_user_and_chat(update, user_info)
 
-        # Step 1: React to the help message with random emoji and animation
-        if EMOJI_REACT:
-            try:
-                random_emoji = random.choice(EMOJI_REACT)
-
-                # Use Telethon for animated emoji reactions
-                if effects_client and update.effective_chat.type == "private":
-                    reaction_sent = await send_animated_reaction(
-                        update.effective_chat.id,
-                        update.message.message_id,
-                        random_emoji
-                    )
-                    if reaction_sent:
-                        log_with_user_info("DEBUG", f"🎭 Added animated emoji reaction: {random_emoji}", user_info)
-                    else:
-                        # Fallback to PTB reaction without animation
-                        await add_ptb_reaction(context, update, random_emoji, user_info)
-                else:
-                    # Group chat or no Telethon - use PTB reaction
-                    await add_ptb_reaction(context, update, random_emoji, user_info)
-
-            except Exception as e:
-                log_with_user_info("WARNING", f"⚠️ Failed to add emoji reaction: {e}", user_info)
-
-        # Step 2: Send photo action indicator
-        await send_photo_action(context, update.effective_chat.id, user_info)
-
-        # Step 3: Prepare help content
+        # Prepare help content
         user_id = update.effective_user.id
         keyboard = create_help_keyboard(user_id, False)
         user_mention = get_user_mention(update.effective_user)
         help_text = get_help_text(user_mention, False)
 
-        # Step 4: Send help message with random image
         random_image = random.choice(SAKURA_IMAGES)
         log_with_user_info("DEBUG", f"📷 Sending help photo: {random_image[:50]}...", user_info)
 
-        # Send with effects if in private chat
-        if update.effective_chat.type == "private":
-            # Use Telethon effects for the main help message
-            effect_sent = await send_with_effect_photo(
+        # Send help photo (with effects where supported) alongside reaction and photo action
+        await run_with_cosmetics(
+            send_effect_message(
                 update.effective_chat.id,
-                random_image,
-                help_text,
-                keyboard
-            )
-            if effect_sent:
-                log_with_user_info("INFO", "✨ Help command with effects sent successfully", user_info)
-            else:
-                # Fallback to normal PTB message if effects fail
-                await context.bot.send_photo(
-                    chat_id=update.effective_chat.id,
-                    photo=random_image,
-                    caption=help_text,
-                    parse_mode=ParseMode.HTML,
-                    reply_markup=keyboard
-                )
-                log_with_user_info("WARNING", "⚠️ Help command sent without effects (fallback)", user_info)
-        else:
-            # Group chat - no effects, just normal message
-            await context.bot.send_photo(
-                chat_id=update.effective_chat.id,
+                update.effective_chat.type,
+                text=help_text,
                 photo=random_image,
-                caption=help_text,
-                parse_mode=ParseMode.HTML,
                 reply_markup=keyboard
-            )
+            ),
+            send_command_reaction(context, update, user_info),
+            send_photo_action(context, update.effective_chat.id, user_info),
+            user_info=user_info
+        )
 
         log_with_user_info("INFO", "✅ Help command completed successfully", user_info)
 
@@ -2209,12 +4502,15 @@ async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
     log_with_user_info("INFO", "📢 Broadcast command received from owner", user_info)
 
     # Refresh counts from database
-    db_users = await get_users_from_database()
-    db_groups = await get_groups_from_database()
+    if ID_STARTUP_MODE == "bloom":
+        await refresh_id_count_estimates()
+    else:
+        db_users = await get_users_from_database()
+        db_groups = await get_groups_from_database()
 
-    # Sync memory with database
-    user_ids.update(db_users)
-    group_ids.update(db_groups)
+        # Sync memory with database
+        user_ids.update(db_users)
+        group_ids.update(db_groups)
 
     keyboard = create_broadcast_keyboard()
     broadcast_text = get_broadcast_text()
@@ -2300,25 +4596,13 @@ async def start_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             user_name = update.effective_user.first_name or ""
             hi_response = await get_gemini_response("Hi sakura", user_name, user_info, update.effective_user.id)
 
-            # Send with effects if in private chat
-            if update.effective_chat.type == "private":
-                # Try sending with effects first
-                effect_sent = await send_with_effect(update.effective_chat.id, hi_response)
-                if effect_sent:
-                    log_with_user_info("INFO", "✨ Start Hi response with effects sent successfully", user_info)
-                else:
-                    # Fallback to normal PTB message if effects fail
-                    await context.bot.send_message(
-                        chat_id=update.effective_chat.id,
-                        text=hi_response
-                    )
-                    log_with_user_info("WARNING", "⚠️ Start Hi response sent without effects (fallback)", user_info)
-            else:
-                # Group chat - no effects, just normal message
-                await context.bot.send_message(
-                    chat_id=update.effective_chat.id,
-                    text=hi_response
-                )
+            # Send with effects where supported (Gemini text is sent without parse mode)
+            await send_effect_message(
+                update.effective_chat.id,
+                update.effective_chat.type,
+                text=hi_response,
+                parse_mode=None
+            )
 
             log_with_user_info("INFO", "✅ Hi message sent from Sakura", user_info)
 
@@ -2444,10 +4728,10 @@ async def broadcast_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
         broadcast_mode[OWNER_ID] = "users"
         await query.edit_message_text(
-            BROADCAST_MESSAGES["ready_users"].format(count=len(user_ids)),
+            BROADCAST_MESSAGES["ready_users"].format(count=count_users()),
             parse_mode=ParseMode.HTML
         )
-        log_with_user_info("INFO", f"✅ Ready to broadcast to {len(user_ids)} users", user_info)
+        log_with_user_info("INFO", f"✅ Ready to broadcast to {count_users()} users", user_info)
 
     elif query.data == "bc_groups":
         # Answer callback with proper message
@@ -2455,77 +4739,103 @@ async def broadcast_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
         broadcast_mode[OWNER_ID] = "groups"
         await query.edit_message_text(
-            BROADCAST_MESSAGES["ready_groups"].format(count=len(group_ids)),
+            BROADCAST_MESSAGES["ready_groups"].format(count=count_groups()),
             parse_mode=ParseMode.HTML
         )
-        log_with_user_info("INFO", f"✅ Ready to broadcast to {len(group_ids)} groups", user_info)
+        log_with_user_info("INFO", f"✅ Ready to broadcast to {count_groups()} groups", user_info)
+
+    elif query.data.startswith("bc_resume:"):
+        # bc_resume:<users|groups>:<f|c>:<message_id>:<last target id>
+        _, target_type, method, message_id, after = query.data.split(':')
+        await query.answer(BROADCAST_MESSAGES["callback_answers"]["resume"], show_alert=False)
+
+        # One resume per failure message
+        await query.edit_message_reply_markup(reply_markup=None)
+        log_with_user_info("INFO", f"▶️ Resuming broadcast to {target_type} after {after}", user_info)
+        await execute_broadcast_direct(
+            context,
+            query.message.chat.id,
+            int(message_id),
+            method == "f",
+            target_type,
+            user_info,
+            after=int(after)
+        )
 
 
 # BROADCAST FUNCTIONS
-async def execute_broadcast_direct(update: Update, context: ContextTypes.DEFAULT_TYPE, target_type: str, user_info: Dict[str, any]) -> None:
-    """Execute broadcast with the current message - uses forward_message for forwarded messages, copy_message for regular messages
-    Compatible with python-telegram-bot==22.3"""
+async def execute_broadcast_direct(context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: int, is_forwarded: bool, target_type: str, user_info: Dict[str, any], after: int = None) -> None:
+    """Execute broadcast of the owner's message - uses forward_message for forwarded messages, copy_message for regular messages
+    Compatible with python-telegram-bot==22.3. Pass `after` to resume from the last target ID reached."""
+    last_target_id = after
+
     try:
         if target_type == "users":
-            # Get fresh data from database
-            target_list = await get_users_from_database()
-            target_list = [uid for uid in target_list if uid != OWNER_ID]
+            target_count = count_users() - (OWNER_ID in user_ids)
             target_name = "users"
         elif target_type == "groups":
-            # Get fresh data from database
-            target_list = await get_groups_from_database()
+            target_count = count_groups()
             target_name = "groups"
         else:
             return
 
-        log_with_user_info("INFO", f"🚀 Starting broadcast to {len(target_list)} {target_name}", user_info)
+        # Page through the table instead of loading the whole audience
+        targets = (
+            target_id
+            async for target_id in iter_broadcast_targets(target_type, after=after)
+            if target_id != OWNER_ID or target_type != "users"
+        )
+
+        log_with_user_info("INFO", f"🚀 Starting broadcast to {target_count} {target_name}", user_info)
 
-        if not target_list:
-            await update.message.reply_text(
-                BROADCAST_MESSAGES["no_targets"].format(target_type=target_name)
+        if not target_count:
+            await context.bot.send_message(
+                chat_id=chat_id,
+                text=BROADCAST_MESSAGES["no_targets"].format(target_type=target_name)
             )
             log_with_user_info("WARNING", f"⚠️ No {target_name} found for broadcast", user_info)
             return
 
-        # Check if the message is forwarded
-        is_forwarded = update.message.forward_origin is not None
         broadcast_method = "forward" if is_forwarded else "copy"
 
         log_with_user_info("INFO", f"📤 Using {broadcast_method} method for broadcast", user_info)
 
         # Show initial status
-        status_msg = await update.message.reply_text(
-            BROADCAST_MESSAGES["progress"].format(count=len(target_list), target_type=target_name)
+        status_msg = await context.bot.send_message(
+            chat_id=chat_id,
+            text=BROADCAST_MESSAGES["progress"].format(count=target_count, target_type=target_name)
         )
 
         broadcast_count = 0
         failed_count = 0
 
         # Broadcast the current message to all targets
-        for i, target_id in enumerate(target_list, 1):
+        i = 0
+        async for target_id in targets:
+            i += 1
+            last_target_id = target_id
             try:
                 if is_forwarded:
                     # Use forward_message for forwarded messages to preserve forwarding chain
                     await context.bot.forward_message(
                         chat_id=target_id,
-                        from_chat_id=update.effective_chat.id,
-                        message_id=update.message.message_id
+                        from_chat_id=chat_id,
+                        message_id=message_id,
+                        rate_limit_args={"lane": "broadcast"}
                     )
                 else:
                     # Use copy_message for regular messages
                     await context.bot.copy_message(
                         chat_id=target_id,
-                        from_chat_id=update.effective_chat.id,
-                        message_id=update.message.message_id
+                        from_chat_id=chat_id,
+                        message_id=message_id,
+                        rate_limit_args={"lane": "broadcast"}
                     )
 
                 broadcast_count += 1
 
                 if i % 10 == 0:  # Log progress every 10 messages
-                    log_with_user_info("DEBUG", f"📡 Broadcast progress: {i}/{len(target_list)} using {broadcast_method}", user_info)
-
-                # Small delay to avoid rate limits
-                await asyncio.sleep(BROADCAST_DELAY)
+                    log_with_user_info("DEBUG", f"📡 Broadcast progress: {i}/{target_count} using {broadcast_method}", user_info)
 
             except Forbidden:
                 failed_count += 1
@@ -2549,19 +4859,29 @@ async def execute_broadcast_direct(update: Update, context: ContextTypes.DEFAULT
         await status_msg.edit_text(
             BROADCAST_MESSAGES["completed"].format(
                 success_count=broadcast_count,
-                total_count=len(target_list),
+                total_count=i,
                 target_type=target_name,
                 failed_count=failed_count
             ) + f"\n<i>Method used: {broadcast_method}</i>",
             parse_mode=ParseMode.HTML
         )
 
-        log_with_user_info("INFO", f"✅ Broadcast completed using {broadcast_method}: {broadcast_count}/{len(target_list)} successful, {failed_count} failed", user_info)
+        log_with_user_info("INFO", f"✅ Broadcast completed using {broadcast_method}: {broadcast_count}/{i} successful, {failed_count} failed", user_info)
 
     except Exception as e:
-        log_with_user_info("ERROR", f"❌ Broadcast error: {e}", user_info)
-        await update.message.reply_text(
-            BROADCAST_MESSAGES["failed"].format(error=str(e))
+        log_with_user_info("ERROR", f"❌ Broadcast error after target {last_target_id}: {e}", user_info)
+
+        # Offer to carry on from the last target reached
+        reply_markup = None
+        if last_target_id is not None:
+            reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton(
+                BROADCAST_MESSAGES["button_texts"]["resume"],
+                callback_data=f"bc_resume:{target_type}:{'f' if is_forwarded else 'c'}:{message_id}:{last_target_id}"
+            )]])
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text=BROADCAST_MESSAGES["failed"].format(error=str(e)),
+            reply_markup=reply_markup
         )
 
 
@@ -2706,7 +5026,14 @@ async def handle_all_messages(update: Update, context: ContextTypes.DEFAULT_TYPE
         # Check if user is owner and in broadcast mode
         if user_id == OWNER_ID and OWNER_ID in broadcast_mode:
             log_with_user_info("INFO", f"📢 Executing broadcast to {broadcast_mode[OWNER_ID]}", user_info)
-            await execute_broadcast_direct(update, context, broadcast_mode[OWNER_ID], user_info)
+            await execute_broadcast_direct(
+                context,
+                update.effective_chat.id,
+                update.message.message_id,
+                update.message.forward_origin is not None,
+                broadcast_mode[OWNER_ID],
+                user_info
+            )
             del broadcast_mode[OWNER_ID]
             return
 
@@ -2728,23 +5055,40 @@ async def handle_all_messages(update: Update, context: ContextTypes.DEFAULT_TYPE
             else:
                 log_with_user_info("INFO", "✅ Responding to group message (mentioned/replied)", user_info)
 
+        # Prefetch rate limit decision and Valkey state in one round trip
+        is_text = not (update.message.sticker or update.message.photo or update.message.poll)
+        state = await prefetch_update_state(
+            user_id,
+            user_info["chat_id"],
+            (update.message.text or update.message.caption or "Media message") if is_text else None
+        )
+
         # Check rate limiting (using Valkey with memory fallback)
-        if await is_rate_limited(user_id, user_info["chat_id"]):
+        if state.rate_limited:
+            stats_history.count("rate_limited")
             log_with_user_info("WARNING", "⏱️ Rate limited - ignoring message", user_info)
             return
 
-        # Handle different message types
-        if update.message.sticker:
-            await handle_sticker_message(update, context)
-        elif update.message.photo:
-            await handle_image_message(update, context)
-        elif update.message.poll:
-            await handle_poll_message(update, context)
-        else:
-            await handle_text_message(update, context)
+        stats_history.count("messages")
 
-        # Update response time after sending response
-        await update_user_response_time_valkey(user_id)
+        token = current_update_state.set(state)
+        try:
+            # Handle different message types
+            if update.message.sticker:
+                await handle_sticker_message(update, context)
+            elif update.message.photo:
+                await handle_image_message(update, context)
+            elif update.message.poll:
+                await handle_poll_message(update, context)
+            else:
+                await handle_text_message(update, context)
+
+            # Update response time after sending response
+            await update_user_response_time_valkey(user_id)
+        finally:
+            current_update_state.reset(token)
+            # Write everything the update buffered in one round trip
+            await flush_update_state(state)
         log_with_user_info("DEBUG", "⏰ Updated user response time in Valkey", user_info)
 
     except Exception as e:
@@ -2802,33 +5146,6 @@ async def buy_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         # Track user for broadcasting
         track_user_and_chat(update, user_info)
 
-        # Step 1: React to the buy message with random emoji and animation
-        if EMOJI_REACT:
-            try:
-                random_emoji = random.choice(EMOJI_REACT)
-
-                # Use Telethon for animated emoji reactions
-                if effects_client and update.effective_chat.type == "private":
-                    reaction_sent = await send_animated_reaction(
-                        update.effective_chat.id,
-                        update.message.message_id,
-                        random_emoji
-                    )
-                    if reaction_sent:
-                        log_with_user_info("DEBUG", f"🎭 Added animated emoji reaction: {random_emoji}", user_info)
-                    else:
-                        # Fallback to PTB reaction without animation
-                        await add_ptb_reaction(context, update, random_emoji, user_info)
-                else:
-                    # Group chat or no Telethon - use PTB reaction
-                    await add_ptb_reaction(context, update, random_emoji, user_info)
-
-            except Exception as e:
-                log_with_user_info("WARNING", f"⚠️ Failed to add emoji reaction: {e}", user_info)
-
-        # Step 1.5: Send typing action
-        await send_typing_action(context, update.effective_chat.id, user_info)
-
         # Default to 50 stars, but allow user to specify amount
         amount = 50
         if len(update.message.text.split()) > 1 and update.message.text.split()[1].isdigit():
@@ -2839,44 +5156,32 @@ async def buy_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             elif amount < 1:
                 amount = 1
 
-        # Step 2: Send invoice with effects if in private chat
-        if update.effective_chat.type == "private":
-            # Use direct API to send invoice with effects
-            try:
-                url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendInvoice"
-                payload = {
-                    'chat_id': update.message.chat.id,
-                    'title': "Flowers 🌸",
-                    'description': random.choice(INVOICE_DESCRIPTIONS),
-                    'payload': f"sakura_star_{update.message.from_user.id}",
-                    'provider_token': "",  # Empty for stars
-                    'currency': "XTR",  # Telegram Stars currency
-                    'prices': [{'label': '✨ Sakura Star', 'amount': amount}],
-                    'message_effect_id': random.choice(EFFECTS)
-                }
+        async def send_flowers_invoice():
+            # Send invoice with effects if in private chat
+            if update.effective_chat.type == "private":
+                # Use direct API to send invoice with effects
+                try:
+                    payload = {
+                        'chat_id': update.message.chat.id,
+                        'title': "Flowers 🌸",
+                        'description': random.choice(INVOICE_DESCRIPTIONS),
+                        'payload': f"sakura_star_{update.message.from_user.id}",
+                        'provider_token': "",  # Empty for stars
+                        'currency': "XTR",  # Telegram Stars currency
+                        'prices': [{'label': '✨ Sakura Star', 'amount': amount}],
+                        'message_effect_id': random.choice(EFFECTS)
+                    }
 
-                async with aiohttp.ClientSession() as session:
-                    async with session.post(url, json=payload) as response:
-                        result = await response.json()
-                        if result.get('ok'):
-                            log_with_user_info("INFO", f"✨ Invoice with effects sent for {amount} stars", user_info)
-                        else:
-                            # Fallback to normal invoice
-                            raise Exception("Effects invoice failed")
-            except Exception:
-                # Fallback to normal PTB invoice
-                await context.bot.send_invoice(
-                    chat_id=update.message.chat.id,
-                    title="Flowers 🌸",
-                    description=random.choice(INVOICE_DESCRIPTIONS),
-                    payload=f"sakura_star_{update.message.from_user.id}",
-                    provider_token="",  # Empty for stars
-                    currency="XTR",  # Telegram Stars currency
-                    prices=[LabeledPrice(label='✨ Sakura Star', amount=amount)]
-                )
-                log_with_user_info("WARNING", f"⚠️ Invoice sent without effects (fallback) for {amount} stars", user_info)
-        else:
-            # Group chat - no effects, just normal invoice
+                    result = await call_bot_api("sendInvoice", payload)
+                    if result.get('ok'):
+                        log_with_user_info("INFO", f"✨ Invoice with effects sent for {amount} stars", user_info)
+                        return
+                except Exception as e:
+                    log_with_user_info("WARNING", f"⚠️ Effects invoice error: {e}", user_info)
+
+                log_with_user_info("WARNING", f"⚠️ Sending invoice without effects (fallback) for {amount} stars", user_info)
+
+            # Group chat or effects failed - normal invoice
             await context.bot.send_invoice(
                 chat_id=update.message.chat.id,
                 title="Flowers 🌸",
@@ -2888,13 +5193,82 @@ async def buy_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             )
             log_with_user_info("INFO", f"✅ Invoice sent for {amount} stars", user_info)
 
+        # Invoice goes out alongside reaction and typing action
+        await run_with_cosmetics(
+            send_flowers_invoice(),
+            send_command_reaction(context, update, user_info),
+            send_typing_action(context, update.effective_chat.id, user_info),
+            user_info=user_info
+        )
+
     except Exception as e:
         user_info = extract_user_info(update.message)
         log_with_user_info("ERROR", f"❌ Error sending invoice: {e}", user_info)
         await update.message.reply_text("❌ Oops! Something went wrong creating the invoice. Try again later! 🔧")
 
+def render_buyers_leaderboard(buyers, total_buyers: int, page: int = 0) -> str:
+    """Render a page of buyers as the /buyers HTML message"""
+    if not buyers:
+        return (
+            "🌸 <b>Flower Buyers</b>\n\n"
+            "No one has bought flowers yet! Be the first to support with /buy 💝"
+        )
+
+    # Build the buyers list
+    buyers_text = "🌸 <b>Flower Buyers</b>\n\n"
+    buyers_text += "💝 <i>Thank you to all our wonderful supporters!</i>\n\n"
+
+    for i, buyer in enumerate(buyers, page * BUYERS_PAGE_SIZE + 1):
+        user_id = buyer['user_id']
+        first_name = (buyer['first_name'] or "Anonymous")[:BUYERS_NAME_LENGTH]
+        total_amount = buyer['total_amount']
+        purchase_count = buyer['purchase_count']
+
+        # Create user mention using first name
+        user_mention = f'<a href="tg://user?id={user_id}">{first_name}</a>'
+
+        # Add rank emoji
+        if i == 1:
+            rank_emoji = "🥇"
+        elif i == 2:
+            rank_emoji = "🥈"
+        elif i == 3:
+            rank_emoji = "🥉"
+        else:
+            rank_emoji = f"{i}."
+
+        buyers_text += f"{rank_emoji} {user_mention} - {total_amount} ⭐"
+        if purchase_count > 1:
+            buyers_text += f" ({purchase_count} purchases)"
+        buyers_text += "\n"
+
+    total_pages = max(1, -(-total_buyers // BUYERS_PAGE_SIZE))
+    buyers_text += f"\n🌸 <i>Total buyers: {total_buyers} • Page {page + 1}/{total_pages}</i>"
+    return buyers_text
+
+
+def create_buyers_keyboard(leaderboard: dict) -> Optional[InlineKeyboardMarkup]:
+    """Create Prev/Next buttons for a /buyers page"""
+    page = leaderboard["page"]
+    buttons = []
+
+    if leaderboard["has_prev"]:
+        if page == 1:
+            callback_data = "buyers_page:0"
+        else:
+            amount, user_id = leaderboard["first"]
+            callback_data = f"buyers_page:{page - 1}:p:{amount}:{user_id}"
+        buttons.append(InlineKeyboardButton("◀️ Prev", callback_data=callback_data))
+
+    if leaderboard["has_next"]:
+        amount, user_id = leaderboard["last"]
+        buttons.append(InlineKeyboardButton("Next ▶️", callback_data=f"buyers_page:{page + 1}:n:{amount}:{user_id}"))
+
+    return InlineKeyboardMarkup([buttons]) if buttons else None
+
+
 async def buyers_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Show all flower buyers with their donation amounts."""
+    """Show the top flower buyers with their donation amounts."""
     try:
         user_info = extract_user_info(update.message)
         log_with_user_info("INFO", "💝 /buyers command received", user_info)
@@ -2902,161 +5276,77 @@ async def buyers_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         # Track user for broadcasting
         track_user_and_chat(update, user_info)
 
-        # Step 1: React to the buyers message with random emoji and animation
-        if EMOJI_REACT:
-            try:
-                random_emoji = random.choice(EMOJI_REACT)
-
-                # Use Telethon for animated emoji reactions
-                if effects_client and update.effective_chat.type == "private":
-                    reaction_sent = await send_animated_reaction(
-                        update.effective_chat.id,
-                        update.message.message_id,
-                        random_emoji
-                    )
-                    if reaction_sent:
-                        log_with_user_info("DEBUG", f"🎭 Added animated emoji reaction: {random_emoji}", user_info)
-                    else:
-                        # Fallback to PTB reaction without animation
-                        await add_ptb_reaction(context, update, random_emoji, user_info)
-                else:
-                    # Group chat or no Telethon - use PTB reaction
-                    await add_ptb_reaction(context, update, random_emoji, user_info)
-
-            except Exception as e:
-                log_with_user_info("WARNING", f"⚠️ Failed to add emoji reaction: {e}", user_info)
-
-        # Step 2: Send typing action
-        await send_typing_action(context, update.effective_chat.id, user_info)
-
-        # Get all purchases from database
-        purchases = await get_all_purchases()
+        # Load the first page while the reaction and typing action are in flight
+        leaderboard = await run_with_cosmetics(
+            get_buyers_leaderboard(),
+            send_command_reaction(context, update, user_info),
+            send_typing_action(context, update.effective_chat.id, user_info),
+            user_info=user_info
+        )
 
-        if not purchases:
-            no_buyers_text = (
-                "🌸 <b>Flower Buyers</b>\n\n"
-                "No one has bought flowers yet! Be the first to support with /buy 💝"
-            )
+        # Send buyers list with effects where supported (private chats)
+        await send_effect_message(
+            update.effective_chat.id,
+            update.effective_chat.type,
+            text=leaderboard["text"],
+            reply_markup=create_buyers_keyboard(leaderboard),
+            reply_to=update.message.message_id,
+            disable_preview=True
+        )
+        log_with_user_info("INFO", "✅ Buyers list sent", user_info)
 
-            # Send with effects if in private chat
-            if update.effective_chat.type == "private":
-                # Use direct API to send no buyers message with effects
-                try:
-                    url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
-                    payload = {
-                        'chat_id': update.effective_chat.id,
-                        'text': no_buyers_text,
-                        'message_effect_id': random.choice(EFFECTS),
-                        'parse_mode': 'HTML'
-                    }
+    except Exception as e:
+        user_info = extract_user_info(update.message)
+        log_with_user_info("ERROR", f"❌ Error in buyers command: {e}", user_info)
+        await update.message.reply_text("❌ Something went wrong getting the buyers list. Try again later! 🔧")
 
-                    async with aiohttp.ClientSession() as session:
-                        async with session.post(url, json=payload) as response:
-                            result = await response.json()
-                            if result.get('ok'):
-                                log_with_user_info("INFO", "✨ No buyers message with effects sent successfully", user_info)
-                            else:
-                                # Fallback to normal PTB message if effects fail
-                                await update.message.reply_text(
-                                    no_buyers_text,
-                                    parse_mode=ParseMode.HTML
-                                )
-                                log_with_user_info("WARNING", "⚠️ No buyers message sent without effects (fallback)", user_info)
-                except Exception:
-                    # Fallback to normal PTB message if effects fail
-                    await update.message.reply_text(
-                        no_buyers_text,
-                        parse_mode=ParseMode.HTML
-                    )
-                    log_with_user_info("WARNING", "⚠️ No buyers message sent without effects (fallback)", user_info)
-            else:
-                # Group chat - no effects, just normal message
-                await update.message.reply_text(
-                    no_buyers_text,
-                    parse_mode=ParseMode.HTML
-                )
 
-            log_with_user_info("INFO", "✅ No buyers found message sent", user_info)
+async def buyers_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle /buyers Prev/Next page callbacks"""
+    query = update.callback_query
+    if query.message.chat.type in ['group', 'supergroup']:
+        try:
+            chat_member = await context.bot.get_chat_member(query.message.chat.id, context.bot.id)
+            if chat_member.status in [ChatMember.LEFT, ChatMember.BANNED]:
+                await query.answer("Add me first, my soul might be here but my body not! 🌸", show_alert=True)
+                return
+        except (BadRequest, Forbidden):
+            await query.answer("Add me first, my soul might be here but my body not! 🌸", show_alert=True)
             return
 
-        # Build the buyers list
-        buyers_text = "🌸 <b>Flower Buyers</b>\n\n"
-        buyers_text += "💝 <i>Thank you to all our wonderful supporters!</i>\n\n"
-
-        for i, purchase in enumerate(purchases, 1):
-            user_id = purchase['user_id']
-            username = purchase['username']
-            first_name = purchase['first_name'] or "Anonymous"
-            total_amount = purchase['total_amount']
-            purchase_count = purchase['purchase_count']
-
-            # Create user mention using first name
-            user_mention = f'<a href="tg://user?id={user_id}">{first_name}</a>'
-
-            # Add rank emoji
-            if i == 1:
-                rank_emoji = "🥇"
-            elif i == 2:
-                rank_emoji = "🥈"
-            elif i == 3:
-                rank_emoji = "🥉"
-            else:
-                rank_emoji = f"{i}."
+    try:
+        user_info = extract_user_info(query.message)
 
-            buyers_text += f"{rank_emoji} {user_mention} - {total_amount} ⭐"
-            if purchase_count > 1:
-                buyers_text += f" ({purchase_count} purchases)"
-            buyers_text += "\n"
+        # buyers_page:<page>[:<n|p>:<total_amount>:<user_id>]
+        parts = query.data.split(':')
+        page = int(parts[1])
+        direction, cursor = None, None
+        if len(parts) == 5:
+            direction, cursor = parts[2], (int(parts[3]), int(parts[4]))
 
-        buyers_text += f"\n🌸 <i>Total buyers: {len(purchases)}</i>"
+        log_with_user_info("INFO", f"💝 Buyers page {page + 1} callback received", user_info)
 
-        # Step 3: Send buyers list with effects if in private chat
-        if update.effective_chat.type == "private":
-            # Use direct API to send buyers list with effects
-            try:
-                url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
-                payload = {
-                    'chat_id': update.effective_chat.id,
-                    'text': buyers_text,
-                    'message_effect_id': random.choice(EFFECTS),
-                    'parse_mode': 'HTML',
-                    'disable_web_page_preview': True
-                }
+        leaderboard = await get_buyers_leaderboard(page, direction, cursor)
+        await query.answer()
 
-                async with aiohttp.ClientSession() as session:
-                    async with session.post(url, json=payload) as response:
-                        result = await response.json()
-                        if result.get('ok'):
-                            log_with_user_info("INFO", f"✨ Buyers list with effects sent with {len(purchases)} buyers", user_info)
-                        else:
-                            # Fallback to normal PTB message if effects fail
-                            await update.message.reply_text(
-                                buyers_text,
-                                parse_mode=ParseMode.HTML,
-                                disable_web_page_preview=True
-                            )
-                            log_with_user_info("WARNING", f"⚠️ Buyers list sent without effects (fallback) with {len(purchases)} buyers", user_info)
-            except Exception:
-                # Fallback to normal PTB message if effects fail
-                await update.message.reply_text(
-                    buyers_text,
-                    parse_mode=ParseMode.HTML,
-                    disable_web_page_preview=True
-                )
-                log_with_user_info("WARNING", f"⚠️ Buyers list sent without effects (fallback) with {len(purchases)} buyers", user_info)
-        else:
-            # Group chat - no effects, just normal message
-            await update.message.reply_text(
-                buyers_text,
-                parse_mode=ParseMode.HTML,
-                disable_web_page_preview=True
-            )
-            log_with_user_info("INFO", f"✅ Buyers list sent with {len(purchases)} buyers", user_info)
+        await query.edit_message_text(
+            text=leaderboard["text"],
+            parse_mode=ParseMode.HTML,
+            reply_markup=create_buyers_keyboard(leaderboard),
+            disable_web_page_preview=True
+        )
 
+    except BadRequest as e:
+        # Another tap already showed this page
+        if "not modified" not in str(e).lower():
+            log_with_user_info("ERROR", f"❌ Error editing buyers page: {e}", extract_user_info(query.message))
     except Exception as e:
-        user_info = extract_user_info(update.message)
-        log_with_user_info("ERROR", f"❌ Error in buyers command: {e}", user_info)
-        await update.message.reply_text("❌ Something went wrong getting the buyers list. Try again later! 🔧")
+        user_info = extract_user_info(query.message) if query.message else {}
+        log_with_user_info("ERROR", f"❌ Error in buyers page callback: {e}", user_info)
+        try:
+            await query.answer("Something went wrong 😔", show_alert=True)
+        except:
+            pass
 
 
 async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -3082,7 +5372,7 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         await update.message.reply_text("❌ Something went wrong getting bot statistics!")
 
 
-async def send_stats_message(chat_id: int, context: ContextTypes.DEFAULT_TYPE, is_refresh: bool = False) -> None:
+async def send_stats_message(chat_id: int, context: ContextTypes.DEFAULT_TYPE, is_refresh: bool = False, hours: int = 1) -> None:
     """Send or update stats message with current data"""
     try:
         # Calculate ping to Telegram servers
@@ -3094,31 +5384,24 @@ async def send_stats_message(chat_id: int, context: ContextTypes.DEFAULT_TYPE, i
             ping_ms = "Error"
 
         # Calculate bot uptime (using process start time)
-        try:
-            boot_time = psutil.boot_time()
-            process = psutil.Process()
-            process_start = process.create_time()
-            uptime_seconds = time.time() - process_start
-
-            # Format uptime
-            days = int(uptime_seconds // 86400)
-            hours = int((uptime_seconds % 86400) // 3600)
-            minutes = int((uptime_seconds % 3600) // 60)
-            uptime_str = f"{days}d {hours}h {minutes}m"
-        except Exception as e:
-            uptime_str = "Unknown"
+        uptime_seconds = time.time() - metrics_sampler.started_at
+
+        # Format uptime
+        days = int(uptime_seconds // 86400)
+        uptime_hours = int((uptime_seconds % 86400) // 3600)
+        minutes = int((uptime_seconds % 3600) // 60)
+        uptime_str = f"{days}d {uptime_hours}h {minutes}m"
 
         # Get current time
         current_time = datetime.datetime.now()
 
-        # System Information
-        cpu_percent = psutil.cpu_percent(interval=0.1)
-        memory = psutil.virtual_memory()
-
         # Database Statistics
+        if ID_STARTUP_MODE == "bloom":
+            await refresh_id_count_estimates()
+
         db_stats = {
-            'users_count': len(user_ids),
-            'groups_count': len(group_ids),
+            'users_count': count_users(),
+            'groups_count': count_groups(),
             'total_purchases': 0,
             'total_revenue': 0,
             'active_conversations': len(conversation_history)
@@ -3127,31 +5410,30 @@ async def send_stats_message(chat_id: int, context: ContextTypes.DEFAULT_TYPE, i
         if db_pool:
             try:
                 async with db_pool.acquire() as conn:
-                    # Get purchase statistics
+                    # Purchase statistics from the running totals and the last 24 hourly rollups
                     purchase_stats = await conn.fetchrow("""
-                        SELECT COUNT(*) as total_purchases, COALESCE(SUM(amount), 0) as total_revenue
-                        FROM purchases
-                    """)
-                    if purchase_stats:
-                        db_stats['total_purchases'] = purchase_stats['total_purchases']
-                        db_stats['total_revenue'] = purchase_stats['total_revenue']
-
-                    # Get recent activity (last 24 hours)
-                    recent_users = await conn.fetchval("""
-                        SELECT COUNT(*) FROM users
-                        WHERE updated_at > NOW() - INTERVAL '24 hours'
-                    """)
-                    db_stats['recent_users'] = recent_users or 0
-
-                    recent_purchases = await conn.fetchval("""
-                        SELECT COUNT(*) FROM purchases
-                        WHERE created_at > NOW() - INTERVAL '24 hours'
+                        SELECT
+                            (SELECT total_purchases FROM purchase_totals) AS total_purchases,
+                            (SELECT total_revenue FROM purchase_totals) AS total_revenue,
+                            (SELECT SUM(purchases) FROM purchase_hourly
+                             WHERE hour > date_trunc('hour', CURRENT_TIMESTAMP) - INTERVAL '24 hours') AS recent_purchases
                     """)
-                    db_stats['recent_purchases'] = recent_purchases or 0
+                    db_stats['total_purchases'] = purchase_stats['total_purchases'] or 0
+                    db_stats['total_revenue'] = purchase_stats['total_revenue'] or 0
+                    db_stats['recent_purchases'] = purchase_stats['recent_purchases'] or 0
 
             except Exception as e:
                 logger.error(f"Error getting database stats: {e}")
 
+        # Recent activity (last 24 hours) from the hourly HyperLogLogs
+        recent_users = await count_recent_active_users()
+        if recent_users is not None:
+            db_stats['recent_users'] = recent_users
+
+        # L1 cache effectiveness
+        l1_lookups = l1_cache.hits + l1_cache.misses
+        l1_hit_rate = round(l1_cache.hits * 100 / l1_lookups, 1) if l1_lookups else 0
+
         # Build stats message
         stats_message = f"""📊 <b>Sakura Bot Statistics</b>
 <i>Last Updated: {current_time.strftime('%H:%M:%S')}</i>
@@ -3169,12 +5451,32 @@ async def send_stats_message(chat_id: int, context: ContextTypes.DEFAULT_TYPE, i
 ├ Total Revenue: <b>{db_stats['total_revenue']} ⭐</b>
 └ Recent Purchases (24h): <b>{db_stats.get('recent_purchases', 'N/A')}</b>
 
-🖥️ <b>System Resources</b>
-├ CPU Usage: <b>{cpu_percent}%</b>
-└ Memory: <b>{memory.percent}%</b> ({memory.used // (1024**3)}GB / {memory.total // (1024**3)}GB)"""
-
-        # Create refresh button
-        keyboard = [[InlineKeyboardButton("🔄 Refresh", callback_data="refresh_stats")]]
+🖥️ <b>System Resources</b> <i>(avg (min / max), last {metrics_sampler.count * METRICS_SAMPLE_INTERVAL}s)</i>
+├ CPU Usage: {format_metric("cpu", lambda value: f"{value:.1f}%")}
+├ Memory: {format_metric("memory", lambda value: f"{value:.1f}%")} of {metrics_sampler.memory_total // (1024**3)}GB
+├ Process RSS: {format_metric("rss", format_bytes)}
+├ ID Store: <b>{format_bytes(user_ids.nbytes())}</b> users, <b>{format_bytes(group_ids.nbytes())}</b> groups{f", <b>{format_bytes(len(id_filter.bits))}</b> filter" if id_filter else ""}
+├ Loop Lag: {format_metric("loop_lag", lambda value: f"{value:.1f}ms")}
+├ Open FDs: {format_metric("fds", lambda value: f"{value:.0f}")}
+└ Tasks: {format_metric("tasks", lambda value: f"{value:.0f}")}
+
+🗄️ <b>Valkey</b>
+├ Circuit: <b>{valkey_breaker.state if valkey_client else 'disconnected'}</b>
+├ Trips: <b>{valkey_breaker.trips}</b>
+├ Recent Failures: <b>{valkey_breaker.failures}</b>
+└ L1 Cache: <b>{len(l1_cache.entries)}</b> entries, <b>{l1_hit_rate}%</b> hits
+
+📈 <b>Trends (last {hours}h)</b>
+<pre>{render_stats_history(hours)}</pre>"""
+
+        # Create range selector and refresh button
+        keyboard = [
+            [
+                InlineKeyboardButton(f"• {option}h •" if option == hours else f"{option}h", callback_data=f"refresh_stats:{option}")
+                for option in STATS_RANGES
+            ],
+            [InlineKeyboardButton("🔄 Refresh", callback_data=f"refresh_stats:{hours}")]
+        ]
         reply_markup = InlineKeyboardMarkup(keyboard)
 
         if is_refresh:
@@ -3222,7 +5524,12 @@ async def stats_refresh_callback(update: Update, context: ContextTypes.DEFAULT_T
         await query.answer("🔄 Refreshing statistics...", show_alert=False)
 
         # Get updated stats
-        stats_message, reply_markup = await send_stats_message(query.message.chat.id, context, is_refresh=True)
+        # refresh_stats[:<hours>] - messages sent before the range selector carry no range
+        hours = int(query.data.split(':')[1]) if ':' in query.data else 1
+        if hours not in STATS_RANGES:
+            hours = 1
+
+        stats_message, reply_markup = await send_stats_message(query.message.chat.id, context, is_refresh=True, hours=hours)
 
         # Update the message
         await query.edit_message_text(
@@ -3336,35 +5643,15 @@ async def successful_payment_callback(update: Update, context: ContextTypes.DEFA
             # Send refund message with button and effects
             refund_msg = random.choice(REFUND_MESSAGES)
 
-            # Send with effects if in private chat
-            if update.message.chat.type == "private":
-                # Use direct API to send refund message with effects
-                try:
-                    url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
-                    payload = {
-                        'chat_id': update.message.chat.id,
-                        'text': refund_msg,
-                        'message_effect_id': random.choice(EFFECTS),
-                        'parse_mode': 'HTML',
-                        'reply_markup': reply_markup.to_json()
-                    }
-
-                    async with aiohttp.ClientSession() as session:
-                        async with session.post(url, json=payload) as response:
-                            result = await response.json()
-                            if result.get('ok'):
-                                log_with_user_info("INFO", "✨ Refund message with effects sent successfully", user_info)
-                            else:
-                                # Fallback to normal PTB message if effects fail
-                                await update.message.reply_text(refund_msg, reply_markup=reply_markup)
-                                log_with_user_info("WARNING", "⚠️ Refund message sent without effects (fallback)", user_info)
-                except Exception:
-                    # Fallback to normal PTB message if effects fail
-                    await update.message.reply_text(refund_msg, reply_markup=reply_markup)
-                    log_with_user_info("WARNING", "⚠️ Refund message sent without effects (fallback)", user_info)
-            else:
-                # Group chat - no effects, just normal message
-                await update.message.reply_text(refund_msg, reply_markup=reply_markup)
+            # Send with effects where supported (private chats)
+            await send_effect_message(
+                update.message.chat.id,
+                update.message.chat.type,
+                text=refund_msg,
+                reply_markup=reply_markup,
+                reply_to=update.message.message_id,
+                parse_mode=None
+            )
 
             log_with_user_info("INFO", "✅ Refund completed successfully", user_info)
 
@@ -3392,35 +5679,15 @@ async def successful_payment_callback(update: Update, context: ContextTypes.DEFA
         # Send thank you message with button and effects
         success_msg = random.choice(THANK_YOU_MESSAGES)
 
-        # Send with effects if in private chat
-        if update.message.chat.type == "private":
-            # Use direct API to send thank you message with effects
-            try:
-                url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
-                payload = {
-                    'chat_id': update.message.chat.id,
-                    'text': success_msg,
-                    'message_effect_id': random.choice(EFFECTS),
-                    'parse_mode': 'HTML',
-                    'reply_markup': reply_markup.to_json()
-                }
-
-                async with aiohttp.ClientSession() as session:
-                    async with session.post(url, json=payload) as response:
-                        result = await response.json()
-                        if result.get('ok'):
-                            log_with_user_info("INFO", "✨ Thank you message with effects sent successfully", user_info)
-                        else:
-                            # Fallback to normal PTB message if effects fail
-                            await update.message.reply_text(success_msg, reply_markup=reply_markup)
-                            log_with_user_info("WARNING", "⚠️ Thank you message sent without effects (fallback)", user_info)
-            except Exception:
-                # Fallback to normal PTB message if effects fail
-                await update.message.reply_text(success_msg, reply_markup=reply_markup)
-                log_with_user_info("WARNING", "⚠️ Thank you message sent without effects (fallback)", user_info)
-        else:
-            # Group chat - no effects, just normal message
-            await update.message.reply_text(success_msg, reply_markup=reply_markup)
+        # Send with effects where supported (private chats)
+        await send_effect_message(
+            update.message.chat.id,
+            update.message.chat.type,
+            text=success_msg,
+            reply_markup=reply_markup,
+            reply_to=update.message.message_id,
+            parse_mode=None
+        )
 
         log_with_user_info("INFO", "✅ Payment processed successfully", user_info)
 
@@ -3453,7 +5720,8 @@ def setup_handlers(application: Application) -> None:
     application.add_handler(CallbackQueryHandler(start_callback, pattern="^start_"))
     application.add_handler(CallbackQueryHandler(help_callback, pattern="^help_expand_"))
     application.add_handler(CallbackQueryHandler(broadcast_callback, pattern="^bc_|^get_flowers_again$"))
-    application.add_handler(CallbackQueryHandler(stats_refresh_callback, pattern="^refresh_stats$"))
+    application.add_handler(CallbackQueryHandler(stats_refresh_callback, pattern=r"^refresh_stats(:\d+)?$"))
+    application.add_handler(CallbackQueryHandler(buyers_page_callback, pattern="^buyers_page:"))
 
     # Payment handlers
     application.add_handler(PreCheckoutQueryHandler(precheckout_callback))
@@ -3482,31 +5750,63 @@ def run_bot() -> None:
 
     logger.info("🚀 Initializing Sakura Bot...")
 
+    # Count errors for /stats trends from here on, not import-time config errors
+    logger.addHandler(ErrorCountHandler(logging.ERROR))
+
     # Create application
-    application = Application.builder().token(BOT_TOKEN).concurrent_updates(True).build()
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(True)
+        .rate_limiter(rate_governor)
+        .build()
+    )
 
     # Setup handlers
     setup_handlers(application)
 
     # Setup bot commands and database using post_init
     async def post_init(app):
-        global cleanup_task
+        global cleanup_task, migration_task, invalidation_task, activity_task
 
         # Initialize Valkey
         valkey_success = await init_valkey()
-        if not valkey_success:
+        if valkey_success:
+            # Move old flat per-user keys into the per-user hash schema in the background
+            migration_task = asyncio.create_task(migrate_legacy_user_keys())
+
+            # Keep L1 coherent with writes from other replicas
+            if STORAGE_BACKEND == "valkey":
+                invalidation_task = asyncio.create_task(l1_invalidation_listener())
+
+            # Flush buffered active users into the hourly rollups
+            activity_task = asyncio.create_task(activity_flusher())
+        elif STORAGE_BACKEND != "memory":
             logger.warning("⚠️ Valkey initialization failed. Bot will continue with memory fallback.")
 
         # Initialize database
         db_success = await init_database()
-        if not db_success:
+        if db_success:
+            # Batched user and group upserts
+            user_upserts.start()
+            group_upserts.start()
+        else:
             logger.error("❌ Database initialization failed. Bot will continue without persistence.")
 
+        # Initialize shared Bot API HTTP session
+        await init_http_session()
+
         # Start Telethon effects client
         await start_effects_client()
 
         await setup_bot_commands(app)
 
+        # Sample CPU, memory, loop lag, FDs and tasks in the background for /stats
+        metrics_sampler.start()
+
+        # Per-minute load history for /stats trends, restored from Valkey
+        await stats_history.start()
+
         # Start conversation cleanup task and store reference
         cleanup_task = asyncio.create_task(cleanup_old_conversations())
 
@@ -3514,7 +5814,7 @@ def run_bot() -> None:
 
     # Setup shutdown handler
     async def post_shutdown(app):
-        global cleanup_task
+        global cleanup_task, migration_task, invalidation_task, activity_task
 
         # Cancel cleanup task gracefully
         if cleanup_task and not cleanup_task.done():
@@ -3527,8 +5827,26 @@ def run_bot() -> None:
             except Exception as e:
                 logger.error(f"❌ Error cancelling cleanup task: {e}")
 
+        # Stop background work: key migration, L1 invalidation listener, activity flusher, known-ID filter build
+        for task in (migration_task, invalidation_task, activity_task, id_filter_task):
+            if task and not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+
+        await metrics_sampler.stop()
+        await stats_history.stop()
+
+        # Write pending user and group upserts before the pool goes away
+        await user_upserts.stop()
+        await group_upserts.stop()
+
         await close_database()
+        save_id_filter()
         await close_valkey()
+        await close_http_session()
         await stop_effects_client()
         logger.info("🌸 Sakura Bot shutdown completed!")
 